@@ -0,0 +1,18 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def configure_sqlite(sender, connection, **kwargs):
+	if connection.vendor != 'sqlite':
+		return
+	with connection.cursor() as cursor:
+		for name, value in settings.SQLITE_PRAGMAS.items():
+			cursor.execute(f'PRAGMA {name} = {value}')
+
+
+class CoreConfig(AppConfig):
+	name = 'core'
+
+	def ready(self):
+		connection_created.connect(configure_sqlite)
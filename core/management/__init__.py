@@ -1,11 +1,80 @@
-from typing import Optional, Tuple
+import json
+import time
 
-from django.core.management import BaseCommand
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from django.core.management import BaseCommand, CommandParser
+from django.db import connections
 from django.utils.termcolors import colorize
 
 
 class CoreCommand(BaseCommand):
 
+	_stats: Optional['Stats'] = None
+
+	def create_parser(self, prog_name: str, subcommand: str, **kwargs) -> CommandParser:
+		parser = super().create_parser(prog_name, subcommand, **kwargs)
+		parser.add_argument(
+			'--stats',
+			action='store_true',
+			help="""
+				Print statistics to stderr in JSON format when the command
+				finishes: the wall time, database queries, and query time of
+				each phase as well as counters, e. g., of processed rows.
+			""",
+		)
+		parser.add_argument(
+			'--profile',
+			metavar='FILE',
+			help="""
+				Profile the command with cProfile and dump the statistics to
+				the given file, e. g., for `python -m pstats FILE`.
+			""",
+		)
+		return parser
+
+	def execute(self, *args, **options):
+		profile: Optional[str] = options.get('profile')
+
+		with ExitStack() as stack:
+			if options.get('stats'):
+				self._stats = Stats()
+				for connection in connections.all():
+					stack.enter_context(connection.execute_wrapper(self._stats.queries))
+				stack.callback(self.print_stats)
+
+			if profile is not None:
+				import cProfile
+				profiler = cProfile.Profile()
+				stack.callback(profiler.dump_stats, profile)
+				profiler.enable()
+				stack.callback(profiler.disable)
+
+			return super().execute(*args, **options)
+
+	def phase(self, name: str) -> ContextManager[None]:
+		"""
+		Measure the enclosed block as phase `name` if the command is run with
+		`--stats`. Otherwise, this is a no-op that is cheap enough to use in hot
+		paths.
+		"""
+
+		if self._stats is None:
+			return nullcontext()
+		return self._stats.phase(name)
+
+	def count(self, name: str, value: int = 1):
+		if self._stats is not None:
+			self._stats.counters[name] += value
+
+	def print_stats(self):
+		assert self._stats is not None
+		stats = json.dumps(self._stats.as_dict(), separators=(',', ':'))
+		self._stats = None
+		self.stderr.write(stats, style_func=lambda msg: msg)
+
 	def display(self, value: Optional[str]) -> str:
 		if value is None:
 			return '-'
@@ -35,3 +104,93 @@ class CoreCommand(BaseCommand):
 
 	def warn(self, msg: str):
 		self.secho(self.style.WARNING(msg), err=True)
+
+
+class QueryCounter:
+	"""
+	Execute wrapper, see `django.db.connection.execute_wrapper`, counting the
+	queries and the time spent executing them.
+	"""
+
+	def __init__(self):
+		self.count = 0
+		self.time = 0.0
+
+	def __call__(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.count += 1
+			self.time += time.perf_counter() - start
+
+
+class Phase:
+
+	def __init__(self):
+		self.calls = 0
+		self.time = 0.0
+		self.queries = 0
+		self.query_time = 0.0
+
+	def add(self, other: 'Phase'):
+		self.time += other.time
+		self.queries += other.queries
+		self.query_time += other.query_time
+
+	def as_dict(self) -> Dict[str, Any]:
+		return {
+			'calls': self.calls,
+			'seconds': round(self.time, 6),
+			'queries': self.queries,
+			'query_seconds': round(self.query_time, 6),
+		}
+
+
+class Stats:
+	"""
+	Statistics of a command run with `--stats`. The time and queries of a
+	phase do not include those of nested phases, so that the phases add up to
+	at most the total.
+	"""
+
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.queries = QueryCounter()
+		self.phases: Dict[str, Phase] = defaultdict(Phase)
+		self.counters: Dict[str, int] = defaultdict(int)
+		# Totals of the phases nested in each running phase
+		self._nested: List[Phase] = []
+
+	@contextmanager
+	def phase(self, name: str) -> Iterator[None]:
+		start = time.perf_counter()
+		queries = self.queries.count
+		query_time = self.queries.time
+		nested = Phase()
+		self._nested.append(nested)
+		try:
+			yield
+		finally:
+			self._nested.pop()
+			elapsed = Phase()
+			elapsed.time = time.perf_counter() - start
+			elapsed.queries = self.queries.count - queries
+			elapsed.query_time = self.queries.time - query_time
+			if self._nested:
+				self._nested[-1].add(elapsed)
+
+			phase = self.phases[name]
+			phase.calls += 1
+			phase.time += elapsed.time - nested.time
+			phase.queries += elapsed.queries - nested.queries
+			phase.query_time += elapsed.query_time - nested.query_time
+
+	def as_dict(self) -> Dict[str, Any]:
+		return {
+			'seconds': round(time.perf_counter() - self.start, 6),
+			'queries': self.queries.count,
+			'query_seconds': round(self.queries.time, 6),
+			'phases': {name: phase.as_dict() for name, phase in self.phases.items()},
+			'counters': dict(self.counters),
+		}
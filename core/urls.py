@@ -13,9 +13,15 @@ Including another URLconf
 	1. Import the include() function: from django.urls import include, path
 	2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
-from django.urls import path
+from django.apps import apps
+from django.urls import include, path
 
 urlpatterns = [
-	path('admin/', admin.site.urls),
+	path('api/', include('mas_cache.urls')),
 ]
+
+# The admin is not installed for the command-line interface, see `PROFILE` in
+# `core.settings`.
+if apps.is_installed('django.contrib.admin'):
+	from django.contrib import admin
+	urlpatterns.insert(0, path('admin/', admin.site.urls))
@@ -1,4 +1,11 @@
+from typing import Optional
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.fields.json import KeyTextTransform, KeyTransform
+from django.utils.functional import cached_property
+from django.utils.timezone import datetime
 
 from mas_cache.models import (
 	Application,
@@ -10,14 +17,61 @@ from mas_cache.models import (
 )
 
 
+# Pagination
+
+
+class EstimatedCountPaginator(Paginator):
+	"""
+	Paginator that uses the row estimate of the query planner instead of an
+	exact, but slow, count for unfiltered change lists of large tables.
+	"""
+
+	# Tables with fewer rows are counted exactly
+	threshold = 100000
+
+	@cached_property
+	def count(self) -> int:
+		queryset = self.object_list
+		connection = connections[queryset.db]
+		if connection.vendor == 'postgresql' and not queryset.query.where:
+			# The estimate of a partitioned table is the sum of its partitions,
+			# see `mas_cache.partitions`.
+			with connection.cursor() as cursor:
+				cursor.execute('''
+					SELECT SUM(GREATEST(reltuples, 0))::bigint
+					FROM pg_class
+					WHERE oid = %s::regclass OR oid IN (
+						SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass
+					)
+				''', [queryset.model._meta.db_table] * 2)
+				row = cursor.fetchone()
+			# Tables that have never been analyzed have no estimate.
+			if row is not None and row[0] is not None and self.threshold <= row[0]:
+				return row[0]
+		return super().count
+
+
 # Inlines
 
 
 class ChartEntryInline(admin.TabularInline):
+	# Entries are read-only, since charts are read from their packed
+	# applications, which are not updated by changes of entries.
 	model = ChartEntry
+	can_delete = False
 	extra = 0
+	max_num = 0
+	fields = ['position', 'application_id', 'name', 'timestamp']
+	readonly_fields = ['position', 'application_id', 'name', 'timestamp']
 	ordering = ['position']
-	autocomplete_fields = ['application']
+	raw_id_fields = ['application']
+
+	def get_queryset(self, request):
+		# The latest metadata is annotated, instead of querying it per entry.
+		return super().get_queryset(request).with_latest()
+
+	def name(self, entry: ChartEntry) -> Optional[str]:
+		return entry.latest_name
 
 
 # Admin Models
@@ -34,7 +88,45 @@ class ApplicationAdmin(admin.ModelAdmin):
 		'is_known',
 	]
 	ordering = ['itunes_id']
-	search_fields = ['name', 'itunes_id']
+	paginator = EstimatedCountPaginator
+	show_full_result_count = False
+	# Enables the search box, the lookups are defined by get_search_results.
+	search_fields = ['itunes_id']
+
+	def get_search_results(self, request, queryset, search_term):
+		# Only use lookups that are backed by an index: the ID, an exact bundle
+		# identifier, or a name prefix.
+		search_term = search_term.strip()
+		if not search_term:
+			return queryset, False
+		matches = (
+			queryset.with_bundle_identifier(search_term)
+			| queryset.with_name(search_term, prefix=True)
+		)
+		if search_term.isdigit():
+			matches |= queryset.filter(itunes_id=int(search_term))
+		return matches, False
+
+	def get_queryset(self, request):
+		# The latest metadata is annotated, instead of querying it per row.
+		return super().get_queryset(request).with_latest()
+
+	def name(self, app: Application) -> Optional[str]:
+		return app.latest_name
+
+	def bundle_identifier(self, app: Application) -> Optional[str]:
+		return app.latest_bundle_identifier
+
+	def timestamp(self, app: Application) -> Optional[datetime]:
+		return app.latest_timestamp
+
+	def is_bundle(self, app: Application) -> bool:
+		return app.latest_app_type == 'app-bundles'
+	is_bundle.boolean = True  # type: ignore
+
+	def is_known(self, app: Application) -> bool:
+		return app.latest_is_known
+	is_known.boolean = True  # type: ignore
 
 
 @admin.register(AppStore)
@@ -54,7 +146,17 @@ class ChartAdmin(admin.ModelAdmin):
 
 @admin.register(ChartEntry)
 class ChartEntryAdmin(admin.ModelAdmin):
-	list_display = ['chart', 'position', 'application']
+	list_display = ['chart', 'position', 'application_id', 'name']
+	list_select_related = ['chart']
+	paginator = EstimatedCountPaginator
+	raw_id_fields = ['chart', 'application']
+	show_full_result_count = False
+
+	def get_queryset(self, request):
+		return super().get_queryset(request).with_latest()
+
+	def name(self, entry: ChartEntry) -> Optional[str]:
+		return entry.latest_name
 
 
 @admin.register(Genre)
@@ -69,5 +171,19 @@ class GenreAdmin(admin.ModelAdmin):
 
 @admin.register(Metadata)
 class MetadataAdmin(admin.ModelAdmin):
-	date_hierarchy = 'timestamp'
-	list_display = ['store', 'application', 'timestamp']
+	# No date hierarchy, since it aggregates the dates of the whole table.
+	list_display = ['store', 'application_id', 'name', 'timestamp']
+	list_select_related = ['store']
+	paginator = EstimatedCountPaginator
+	raw_id_fields = ['application', 'blob']
+	show_full_result_count = False
+
+	def get_queryset(self, request):
+		# Only the name of the snapshot is extracted from its data, instead of
+		# loading the whole blob.
+		return super().get_queryset(request).annotate(
+			snapshot_name=KeyTextTransform('name', KeyTransform('attributes', 'blob__data')),
+		)
+
+	def name(self, metadata: Metadata) -> Optional[str]:
+		return metadata.snapshot_name
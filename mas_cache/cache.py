@@ -0,0 +1,353 @@
+"""
+Access to the cache of the Mac App Store (MAS) and normalization of cached
+responses.
+
+Nothing in this module touches the database or requires Django to be set up,
+so that responses can be read and decoded in worker processes, while a single
+process writes the resulting records to the database.
+"""
+
+import os
+import sqlite3
+import tempfile
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlparse
+
+from mas_cache.decoder import WILDCARD, Document
+
+
+ReceiverData = Union[bytes, str]
+
+
+class CacheEntry(NamedTuple):
+	entry_id: int
+	source: str
+	timestamp: datetime
+
+
+class GenreRecord(NamedTuple):
+	itunes_id: int
+	name: Optional[str] = None
+	parent: Optional[int] = None
+
+
+class ChartRecord(NamedTuple):
+	genre: int
+	chart_type: str  # As used by the API, e. g., top-free
+	app_ids: List[int]
+
+
+class Resource(NamedTuple):
+	source: str
+	country: str
+	genres: List[GenreRecord]
+	apps: Iterable[Dict[str, Any]]
+	charts: List[ChartRecord]
+	warnings: List[str]
+
+
+class Cache:
+
+	def __init__(self, path: str, read_only: bool = False):
+		self.path = path
+		# Snapshots are opened read-only, so that they are neither created nor
+		# modified, while the live cache of the MAS is opened as usual.
+		self.read_only = read_only
+		self._db: Optional[sqlite3.Connection] = None
+
+	@property
+	def data_dir(self) -> str:
+		return os.path.join(self.path, 'fsCachedData')
+
+	@property
+	def db(self) -> sqlite3.Connection:
+		if self._db is None:
+			fn = os.path.join(self.path, 'Cache.db')
+			if self.read_only:
+				self._db = sqlite3.connect(f'{Path(fn).absolute().as_uri()}?mode=ro', uri=True)
+			else:
+				self._db = sqlite3.connect(fn)
+		return self._db
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
+
+	def identity(self) -> Tuple[int, int]:
+		"""
+		Return an identifier of the `Cache.db` file, which changes if the file
+		is replaced, e. g., when the MAS clears its cache.
+		"""
+
+		st = os.stat(os.path.join(self.path, 'Cache.db'))
+		return st.st_dev, st.st_ino
+
+	def data_version(self) -> int:
+		"""
+		Return a value that changes whenever another connection commits changes
+		to the cache. This is cheap enough to be polled frequently.
+		"""
+
+		return self.db.execute('PRAGMA data_version;').fetchone()[0]
+
+	def entries(self) -> List[CacheEntry]:
+		rows = self.db.execute('''
+			SELECT
+				cfurl_cache_response.entry_ID,
+				cfurl_cache_response.request_key,
+				cfurl_cache_response.time_stamp
+			FROM
+				cfurl_cache_response
+			WHERE
+				cfurl_cache_response.request_key LIKE 'https://api.apps.apple.com/v1/%';
+		''').fetchall()
+
+		entries: List[CacheEntry] = []
+		for row in rows:
+			timestamp = datetime.fromisoformat(row[2])
+			if timestamp.tzinfo is None:
+				timestamp = timestamp.replace(tzinfo=timezone.utc)
+			entries.append(CacheEntry(row[0], row[1], timestamp))
+		return entries
+
+	def read(self, entry_id: int) -> Optional[Tuple[Document, List[str]]]:
+		"""
+		Return the cached data of an entry along with warnings that occurred
+		while locating it, or `None` if no data is cached for the entry.
+		"""
+
+		row = self.db.execute('''
+			SELECT
+				cfurl_cache_receiver_data.receiver_data,
+				cfurl_cache_receiver_data.isDataOnFS
+			FROM
+				cfurl_cache_receiver_data
+			WHERE
+				cfurl_cache_receiver_data.entry_ID == ?;
+		''', (entry_id,)).fetchone()
+		if row is None:
+			return None
+
+		receiver_data: ReceiverData = row[0]
+		should_be_on_fs = bool(row[1])
+
+		warnings: List[str] = []
+
+		if isinstance(receiver_data, str):
+			resource_id: str = receiver_data
+
+			if not should_be_on_fs:
+				warnings.append(f"Resource might not be cached, trying to locate anyway: {resource_id}")
+
+			resource_fn = os.path.join(self.data_dir, resource_id)
+
+			return Document.from_file(resource_fn), warnings
+
+		assert isinstance(receiver_data, bytes)
+
+		return Document(receiver_data), warnings
+
+
+def find_cache_dir(root: str) -> str:
+	"""
+	Return the directory below `root` that contains a `Cache.db`. If there are
+	multiple, the one closest to `root` is returned.
+	"""
+
+	for dirpath, dirnames, filenames in os.walk(root):
+		if 'Cache.db' in filenames:
+			return dirpath
+		dirnames.sort()
+	raise FileNotFoundError(f"No Cache.db found in: {root}")
+
+
+# Archives are rarely scanned, so tarfile and zipfile are only imported when
+# needed, which speeds up starting the scan command.
+
+
+def _is_archive(path: str) -> bool:
+	import tarfile
+	import zipfile
+	return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def _extract(archive: str, destination: str):
+	import tarfile
+	import zipfile
+
+	if zipfile.is_zipfile(archive):
+		with zipfile.ZipFile(archive) as zf:
+			zf.extractall(destination)
+		return
+
+	with tarfile.open(archive) as tf:
+		data_filter = getattr(tarfile, 'data_filter', None)
+		if data_filter is not None:
+			tf.extractall(destination, filter=data_filter)
+			return
+		root = os.path.realpath(destination)
+		for member in tf.getmembers():
+			target = os.path.realpath(os.path.join(root, member.name))
+			if not (member.isfile() or member.isdir()):
+				continue
+			if os.path.commonpath([root, target]) != root:
+				raise ValueError(f"Archive member outside of destination: {member.name}")
+			tf.extract(member, root)
+
+
+@contextmanager
+def open_snapshot(path: str) -> Iterator[Cache]:
+	"""
+	Open a copy of the MAS cache, i. e., a `Cache.db` along with its
+	`fsCachedData` directory. The path can either point to the `Cache.db`
+	itself, to a directory containing it, or to a tar or zip archive of such a
+	directory. Archives are extracted to a temporary directory, which is
+	removed afterwards.
+	"""
+
+	with tempfile.TemporaryDirectory(prefix='mas-cache-') as tmp:
+		if os.path.isdir(path):
+			cache_dir = find_cache_dir(path)
+		elif not os.path.isfile(path):
+			raise FileNotFoundError(f"No such file or directory: {path}")
+		elif os.path.basename(path) == 'Cache.db':
+			cache_dir = os.path.dirname(path) or '.'
+		elif _is_archive(path):
+			_extract(path, tmp)
+			cache_dir = find_cache_dir(tmp)
+		else:
+			raise ValueError(f"Not a Cache.db, directory, or archive: {path}")
+
+		cache = Cache(cache_dir, read_only=True)
+		try:
+			yield cache
+		finally:
+			cache.close()
+
+
+def parse_resource(
+	document: Document,
+	source: str,
+	warnings: Optional[List[str]] = None,
+) -> Resource:
+	"""
+	Normalize a cached response. Applications are yielded lazily from the
+	document, which therefore needs to stay open until they are consumed.
+	"""
+
+	# Deconstruct URL
+	url = urlparse(source)
+	path = Path(url.path)
+	assert 3 < len(path.parts), f"Unknown URL: {url}"
+	mode = path.parts[2]
+	country = path.parts[3]
+
+	genres: List[GenreRecord] = []
+	apps: Iterable[Dict[str, Any]] = ()
+	charts: List[ChartRecord] = []
+
+	if mode == 'catalog':
+		# Deconstruct URL further
+		assert 4 < len(path.parts), f"Unknown URL: {url}"
+		sub_mode = path.parts[4]
+
+		if sub_mode in ['apps', 'contents']:
+			apps = document.values(('data', WILDCARD))
+		elif sub_mode == 'search':
+			apps = document.values(('results', 'search', 'data', WILDCARD))
+		elif sub_mode == 'charts':
+			# Extract genre
+			query = parse_qs(url.query)
+			assert 'genre' in query
+			assert len(query['genre']) == 1
+			genre = int(query['genre'][0])
+			genres.append(GenreRecord(genre))
+
+			# Split charts by type
+			chart_positions: Dict[str, int] = {}
+			for chart_pos in document.positions(('results', 'apps', WILDCARD)):
+				chart_type: str = document.value(('chart',), chart_pos)
+				chart_positions[chart_type] = chart_pos
+
+			for chart_type, chart_pos in chart_positions.items():
+				app_ids = document.values(('data', WILDCARD, 'id'), chart_pos)
+				charts.append(ChartRecord(
+					genre,
+					chart_type,
+					[int(app_id) for app_id in app_ids],
+				))
+
+			# For some of the apps, the metadata has been prefetched.
+			apps = (
+				app_data
+				for chart_pos in chart_positions.values()
+				for app_data in document.values(('data', WILDCARD), chart_pos)
+			)
+		else:
+			assert False, f"Unhandled {mode} sub-mode: {sub_mode}"
+	elif mode == 'editorial':
+		assert 4 < len(path.parts)
+		sub_mode = path.parts[4]
+		if sub_mode == 'categories':
+			categories = document.values(('results', 'categories', WILDCARD))
+			for category in categories:
+				parent = int(category['genre'])
+				genres.append(GenreRecord(parent, category['name']))
+				for child in category['children']:
+					genres.append(GenreRecord(int(child['genre']), child['name'], parent))
+		else:
+			rooms: List[int] = []
+			for editorial in document.positions(('data', WILDCARD)):
+				editorial_type = document.value(('type',), editorial)
+				if editorial_type == 'groupings':
+					# TODO Handle groupings... apps are nested deep.
+					continue
+				assert editorial_type == 'rooms', source
+				rooms.append(editorial)
+			apps = (
+				app_data
+				for room in rooms
+				for app_data in document.values(
+					('relationships', 'contents', 'data', WILDCARD),
+					room,
+				)
+			)
+	else:
+		assert False, f"Unhandled mode: {mode}"
+
+	return Resource(source, country, genres, apps, charts, warnings or [])
+
+
+# Worker processes
+
+
+_worker_cache: Optional[Cache] = None
+
+
+def init_worker(path: str, read_only: bool = False):
+	global _worker_cache
+	_worker_cache = Cache(path, read_only)
+
+
+def load_resource(entry: CacheEntry) -> Optional[Resource]:
+	"""
+	Read and normalize a cache entry in a worker process. In contrast to
+	`parse_resource`, all applications are decoded, so that the result can be
+	sent to the writing process.
+	"""
+
+	assert _worker_cache is not None, "Worker is not initialized"
+
+	cached = _worker_cache.read(entry.entry_id)
+	if cached is None:
+		return None
+
+	document, warnings = cached
+	with document:
+		resource = parse_resource(document, entry.source, warnings)
+		return resource._replace(apps=list(resource.apps))
@@ -0,0 +1,189 @@
+"""
+Streaming decoder for responses cached by the Mac App Store (MAS).
+
+Responses can be large, e. g., search results or charts contain the metadata
+of hundreds of applications, but usually only the values below a few known
+paths are of interest. Instead of building the whole tree in memory, a
+`Document` only locates values by skipping over the raw JSON and decodes the
+requested values one at a time. Files are memory-mapped, so that only the
+pages that are actually touched are read.
+"""
+
+import json
+import mmap
+import os
+import re
+
+from typing import Any, Iterator, Optional, Tuple, Union
+
+
+Buffer = Union[bytes, mmap.mmap]
+KeyPath = Tuple[str, ...]
+
+# Path component matching every item of an array
+WILDCARD = '*'
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_STRUCTURE = re.compile(rb'["\[\]{}]')
+_SCALAR = re.compile(rb'[^,:\[\]{}\s]+')
+
+
+class Document:
+
+	def __init__(self, buffer: Buffer):
+		self.buffer = buffer
+
+	@classmethod
+	def from_file(cls, filename: str) -> 'Document':
+		with open(filename, 'rb') as fp:
+			if os.fstat(fp.fileno()).st_size == 0:
+				return cls(b'')
+			# The mapping stays valid after the file is closed.
+			return cls(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def close(self):
+		if isinstance(self.buffer, mmap.mmap):
+			self.buffer.close()
+
+	def __enter__(self) -> 'Document':
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _error(self, msg: str, pos: int) -> json.JSONDecodeError:
+		doc = bytes(self.buffer[max(0, pos - 20):pos + 20]).decode(errors='replace')
+		return json.JSONDecodeError(msg, doc, min(pos, 20))
+
+	def _skip_whitespace(self, pos: int) -> int:
+		return _WHITESPACE.match(self.buffer, pos).end()
+
+	def _expect(self, pos: int, token: bytes) -> int:
+		pos = self._skip_whitespace(pos)
+		if self.buffer[pos:pos + 1] != token:
+			raise self._error(f"Expecting {token.decode()!r}", pos)
+		return pos + 1
+
+	def _end_of_value(self, pos: int) -> int:
+		"""
+		Return the position after the value starting at `pos` without decoding
+		the value.
+		"""
+
+		token = self.buffer[pos:pos + 1]
+
+		if token == b'"':
+			match = _STRING.match(self.buffer, pos)
+			if match is None:
+				raise self._error("Unterminated string", pos)
+			return match.end()
+
+		if token in (b'{', b'['):
+			depth = 0
+			while True:
+				match = _STRUCTURE.search(self.buffer, pos)
+				if match is None:
+					raise self._error("Unterminated container", pos)
+				token = match.group()
+				if token == b'"':
+					pos = self._end_of_value(match.start())
+					continue
+				if token in (b'{', b'['):
+					depth += 1
+				else:
+					depth -= 1
+				pos = match.end()
+				if depth == 0:
+					return pos
+
+		match = _SCALAR.match(self.buffer, pos)
+		if match is None:
+			raise self._error("Expecting value", pos)
+		return match.end()
+
+	def _members(self, pos: int) -> Iterator[Tuple[str, int]]:
+		"""
+		Yield the keys and value positions of the object starting at `pos`.
+		"""
+
+		pos = self._expect(pos, b'{')
+		pos = self._skip_whitespace(pos)
+		if self.buffer[pos:pos + 1] == b'}':
+			return
+		while True:
+			end = self._end_of_value(pos)
+			key = json.loads(self.buffer[pos:end])
+			pos = self._skip_whitespace(self._expect(end, b':'))
+			yield key, pos
+			pos = self._skip_whitespace(self._end_of_value(pos))
+			token = self.buffer[pos:pos + 1]
+			if token == b'}':
+				return
+			if token != b',':
+				raise self._error("Expecting ',' delimiter", pos)
+			pos = self._skip_whitespace(pos + 1)
+
+	def _items(self, pos: int) -> Iterator[int]:
+		"""
+		Yield the positions of the items of the array starting at `pos`.
+		"""
+
+		pos = self._expect(pos, b'[')
+		pos = self._skip_whitespace(pos)
+		if self.buffer[pos:pos + 1] == b']':
+			return
+		while True:
+			yield pos
+			pos = self._skip_whitespace(self._end_of_value(pos))
+			token = self.buffer[pos:pos + 1]
+			if token == b']':
+				return
+			if token != b',':
+				raise self._error("Expecting ',' delimiter", pos)
+			pos = self._skip_whitespace(pos + 1)
+
+	def positions(self, path: KeyPath, pos: Optional[int] = None) -> Iterator[int]:
+		"""
+		Yield the positions of all values found at `path` relative to the value
+		starting at `pos` (default: the root value). Path components are either
+		object keys or `WILDCARD`, matching every item of an array.
+		"""
+
+		if pos is None:
+			pos = self._skip_whitespace(0)
+
+		if not path:
+			yield pos
+			return
+
+		head, tail = path[0], path[1:]
+		if head == WILDCARD:
+			for item in self._items(pos):
+				yield from self.positions(tail, item)
+		else:
+			for key, value in self._members(pos):
+				if key == head:
+					yield from self.positions(tail, value)
+					return
+			raise KeyError(head)
+
+	def decode(self, pos: int) -> Any:
+		return json.loads(self.buffer[pos:self._end_of_value(pos)])
+
+	def values(self, path: KeyPath, pos: Optional[int] = None) -> Iterator[Any]:
+		"""
+		Yield the decoded values found at `path`, one at a time.
+		"""
+
+		for value in self.positions(path, pos):
+			yield self.decode(value)
+
+	def value(self, path: KeyPath, pos: Optional[int] = None) -> Any:
+		"""
+		Return the decoded value found at `path`, which must not contain
+		wildcards.
+		"""
+
+		assert WILDCARD not in path
+		return next(self.values(path, pos))
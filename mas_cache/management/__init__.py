@@ -1,3 +1,7 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import datetime
+
 from mas_cache.models import AppStore, Genre
 
 
@@ -13,3 +17,15 @@ def GenreType(value: str) -> Genre:
 		return Genre.objects.get(itunes_id=int(value))
 	except Genre.DoesNotExist:
 		raise ValueError
+
+
+def TimestampType(value: str) -> datetime:
+	timestamp = parse_datetime(value)
+	if timestamp is None:
+		date = parse_date(value)
+		if date is None:
+			raise ValueError
+		timestamp = datetime(date.year, date.month, date.day)
+	if not timezone.is_aware(timestamp):
+		timestamp = timezone.make_aware(timestamp)
+	return timestamp
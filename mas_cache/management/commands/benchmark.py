@@ -0,0 +1,253 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Any, Callable, Dict, List, NamedTuple
+
+from django.conf import settings
+from django.core.management import CommandParser, call_command
+from django.db import connection
+from django.test.utils import override_settings
+
+from core.management import CoreCommand, QueryCounter
+from mas_cache import results
+from mas_cache.models import Application, Metadata, ScannedResponse
+from mas_cache.synthetic import Sizes, generate
+
+
+# Prints the time it takes to import Django and set up all applications
+SETUP = """
+import time
+start = time.perf_counter()
+import django
+django.setup()
+print(time.perf_counter() - start)
+"""
+
+
+class Measurement(NamedTuple):
+	name: str
+	seconds: float  # Median
+	queries: int  # Per call
+
+	def as_dict(self) -> Dict[str, Any]:
+		return {
+			'name': self.name,
+			'ms': round(self.seconds * 1000, 3),
+			'queries': self.queries,
+		}
+
+
+class Command(CoreCommand):
+
+	help = """
+		Benchmark scanning a synthetic cache of the Mac App Store (MAS) and
+		reading charts and metadata afterwards. Reports the throughput of
+		scanning, the latency and number of queries of reading, and the
+		startup time of new processes. A temporary test database and an
+		in-memory cache for results are used, so that existing data is not
+		touched.
+	"""
+
+	def add_arguments(self, parser: CommandParser):
+		defaults = Sizes()
+		parser.add_argument(
+			'--apps',
+			type=int,
+			default=defaults.apps,
+			help=f"""
+				The number of distinct applications in the synthetic cache.
+				(default: {defaults.apps})
+			""",
+		)
+		parser.add_argument(
+			'--genres',
+			type=int,
+			default=defaults.genres,
+			help=f"""
+				The number of genres with charts. (default: {defaults.genres})
+			""",
+		)
+		parser.add_argument(
+			'--chart-size',
+			type=int,
+			default=defaults.chart_size,
+			help=f"""
+				The number of applications per chart. (default: {defaults.chart_size})
+			""",
+		)
+		parser.add_argument(
+			'-j', '--jobs',
+			type=int,
+			default=1,
+			help="""
+				The number of processes used for scanning. (default: 1)
+			""",
+		)
+		parser.add_argument(
+			'-r', '--repeat',
+			type=int,
+			default=20,
+			help="""
+				How often reads are repeated. The median latency is reported.
+				(default: 20)
+			""",
+		)
+		parser.add_argument(
+			'--seed',
+			type=int,
+			default=0,
+			help="""
+				The seed for generating the synthetic cache. (default: 0)
+			""",
+		)
+		parser.add_argument(
+			'--json',
+			action='store_true',
+			help="""
+				Print the results in JSON format.
+			""",
+		)
+
+	def measure(
+		self,
+		name: str,
+		func: Callable[[], Any],
+		repeat: int,
+		before: Callable[[], Any] = lambda: None,
+	) -> Measurement:
+		durations: List[float] = []
+		counter = QueryCounter()
+		for _ in range(repeat):
+			# Queries of the preparation, e. g., the invalidation, are not counted.
+			before()
+			with connection.execute_wrapper(counter):
+				start = time.perf_counter()
+				func()
+				durations.append(time.perf_counter() - start)
+		return Measurement(name, statistics.median(durations), counter.count // repeat)
+
+	def startup(self, repeat: int) -> List[Measurement]:
+		"""
+		Measure starting new processes for both profiles of `core.settings`:
+		the time to import Django and set up the applications, as reported by
+		the process itself, and the wall time of `charts --help`, which does
+		not query the database.
+		"""
+
+		manage = os.path.join(settings.BASE_DIR, 'manage.py')
+		measurements: List[Measurement] = []
+		for profile in ['cli', 'full']:
+			env = dict(os.environ, MAS_CACHE_PROFILE=profile)
+
+			setup: List[float] = []
+			durations: List[float] = []
+			for _ in range(repeat):
+				output = subprocess.run(
+					[sys.executable, '-c', SETUP],
+					env=env,
+					cwd=settings.BASE_DIR,
+					stdout=subprocess.PIPE,
+					check=True,
+				).stdout
+				setup.append(float(output))
+
+				start = time.perf_counter()
+				subprocess.run(
+					[sys.executable, manage, 'charts', '--help'],
+					env=env,
+					stdout=subprocess.DEVNULL,
+					check=True,
+				)
+				durations.append(time.perf_counter() - start)
+
+			measurements.append(Measurement(f'setup ({profile})', statistics.median(setup), 0))
+			measurements.append(Measurement(f'charts --help ({profile})', statistics.median(durations), 0))
+		return measurements
+
+	def run(self, cache_dir: str, options: Dict[str, Any]) -> Dict[str, Any]:
+		repeat: int = options['repeat']
+		with open(os.devnull, 'w') as devnull:
+			def command(*args: str) -> Callable[[], None]:
+				return lambda: call_command(*args, stdout=devnull, stderr=devnull)
+
+			scan = self.measure(
+				'scan',
+				command('scan', '--full', '--jobs', str(options['jobs']), cache_dir),
+				repeat=1,
+			)
+			rows = Metadata.objects.count()
+			entries = ScannedResponse.objects.count()
+
+			app_ids = list(Application.objects.filter(
+				latest_by_store__is_known=True,
+			).order_by('itunes_id').values_list('itunes_id', flat=True)[:repeat])
+
+			def each_app() -> Callable[[], None]:
+				ids = iter(app_ids * repeat)
+				return lambda: call_command('metadata', str(next(ids)), stdout=devnull)
+
+			reads = [
+				self.measure('charts', command('charts', '--json'), repeat, results.invalidate),
+				self.measure('charts (cached)', command('charts', '--json'), repeat),
+				self.measure('charts --history', command('charts', '--history', '--json'), repeat, results.invalidate),
+				self.measure('charts --history (cached)', command('charts', '--history', '--json'), repeat),
+				self.measure('metadata', each_app(), repeat, results.invalidate),
+				self.measure('metadata (cached)', command('metadata', str(app_ids[0])), repeat),
+			]
+
+			return {
+				'scan': {
+					'seconds': round(scan.seconds, 3),
+					'queries': scan.queries,
+					'entries': entries,
+					'rows': rows,
+					'entries_per_second': round(entries / scan.seconds, 1),
+					'rows_per_second': round(rows / scan.seconds, 1),
+				},
+				'reads': [measurement.as_dict() for measurement in reads],
+				'startup': [
+					measurement.as_dict()
+					for measurement in self.startup(min(repeat, 5))
+				],
+			}
+
+	def handle(self, *args, **options):
+		sizes = Sizes(
+			apps=options['apps'],
+			genres=options['genres'],
+			chart_size=options['chart_size'],
+		)
+
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		try:
+			with tempfile.TemporaryDirectory(prefix='mas-cache-') as tmp, override_settings(CACHES={
+				'default': {
+					'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+				},
+			}):
+				generate(tmp, sizes, seed=options['seed'])
+				result = self.run(tmp, options)
+		finally:
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		if options['json']:
+			self.echo(json.dumps(result, separators=(',', ':')))
+			return
+
+		scan = result['scan']
+		self.secho("Scan", fg='white', bold=True)
+		self.secho(f"{scan['entries']} entries, {scan['rows']} metadata rows in {scan['seconds']:.2f}s, {scan['queries']} queries")
+		self.secho(f"{scan['entries_per_second']:.1f} entries/s, {scan['rows_per_second']:.1f} rows/s")
+		self.secho("")
+		self.secho(f"{'Read':<20s} {'Median':>10s} {'Queries':>8s}", fg='white', bold=True)
+		for read in result['reads']:
+			self.secho(f"{read['name']:<20s} {read['ms']:>8.2f}ms {read['queries']:>8d}")
+		self.secho("")
+		self.secho(f"{'Startup':<26s} {'Median':>10s}", fg='white', bold=True)
+		for startup in result['startup']:
+			self.secho(f"{startup['name']:<26s} {startup['ms']:>8.2f}ms")
@@ -1,15 +1,19 @@
 import json
 
+from typing import List, Optional
+
 from django.core.management import CommandError, CommandParser
+from django.utils.timezone import datetime
 
 from core.management import CoreCommand
-from mas_cache.management import AppStoreType, GenreType
-from mas_cache.models import (
-	AppStore,
-	Chart,
-	ChartEntry,
-	ChartType,
-	Genre,
+from mas_cache.management import AppStoreType, GenreType, TimestampType
+from mas_cache.models import APP_STORE_GENRE, AppStore, ChartType, Genre
+from mas_cache.results import (
+	HistoryRow,
+	chart_history,
+	default_genre,
+	default_store,
+	latest_chart,
 )
 
 
@@ -19,7 +23,8 @@ CHART_CHOICES = ['free', 'paid']
 class Command(CoreCommand):
 
 	help = """
-		Print or export latest Mac App Store (MAS) charts.
+		Print or export latest Mac App Store (MAS) charts, or the history of
+		chart positions.
 	"""
 
 	def add_arguments(self, parser: CommandParser):
@@ -73,16 +78,15 @@ class Command(CoreCommand):
 		parser.add_argument(
 			'-g', '--genre',
 			type=GenreType,
-			default=Genre.objects.get(itunes_id=36),
-			help="""
+			help=f"""
 				Output charts for a specified genre. The value passed needs to
-				be a valid iTunes genre identifier. (default: App Store [36])
+				be a valid iTunes genre identifier. (default: App Store
+				[{APP_STORE_GENRE}])
 			""",
 		)
 		parser.add_argument(
 			'-s', '--store',
 			type=AppStoreType,
-			default=AppStore.objects.first(),
 			help="""
 				Output charts for a specific store. Since in most cases only a
 				single store is present, the first one found in the database is
@@ -90,6 +94,35 @@ class Command(CoreCommand):
 				e. g., us or de.
 			""",
 		)
+		parser.add_argument(
+			'--history',
+			action='store_true',
+			help="""
+				Output the position of each application across all stored
+				charts instead of only the latest chart, along with its
+				movement since the previous chart and whether it entered or
+				exited the chart.
+			""",
+		)
+		parser.add_argument(
+			'--since',
+			type=TimestampType,
+			metavar='TIMESTAMP',
+			help="""
+				Only include charts from this point in time on, e. g.,
+				2020-06-01 or 2020-06-01T12:00:00+02:00. Implies --history.
+			""",
+		)
+		parser.add_argument(
+			'--at',
+			type=TimestampType,
+			metavar='TIMESTAMP',
+			help="""
+				Output the chart as it was at the given point in time instead
+				of the latest one. With --history, only include charts up to
+				this point in time.
+			""",
+		)
 
 	def head(self, name: str, info: str):
 		self.secho(name, fg='white', bold=True, ending=': ')
@@ -100,42 +133,71 @@ class Command(CoreCommand):
 		output_json: bool = options['json']
 		skip_bundles: bool = options['skip_bundles']
 		skip_unknown: bool = options['skip_unknown']
-		genre: Genre = options['genre']
-		store: AppStore = options['store']
+		genre: Optional[Genre] = options['genre']
+		store: Optional[AppStore] = options['store']
 		chart_type = ChartType(CHART_CHOICES.index(options['type']))
+		since: Optional[datetime] = options['since']
+		at: Optional[datetime] = options['at']
 
-		charts = Chart.objects.filter(
-			genre=genre,
-			store=store,
-			chart_type=chart_type,
-		).order_by('-timestamp')
-
-		if not charts.exists():
-			raise CommandError("No charts found.")
+		# Defaults are only resolved when needed, so that parsing arguments,
+		# e. g., for --help, does not query the database.
+		if store is None:
+			store = default_store()
+			if store is None:
+				raise CommandError("No stores found.")
+		if genre is None:
+			genre = default_genre()
+			if genre is None:
+				raise CommandError("No charts found.")
 
-		chart = charts.first()
+		if options['history'] or since is not None:
+			if output_list:
+				raise CommandError("--list cannot be combined with --history.")
+			self.output_history(
+				chart_history(
+					store,
+					genre,
+					chart_type,
+					skip_bundles,
+					skip_unknown,
+					since,
+					at,
+					names=not output_json,
+				),
+				genre,
+				store,
+				chart_type,
+				output_json,
+			)
+			return
 
-		entries = ChartEntry.objects.filter(chart=chart).order_by('position')
+		# Charts only change when scanning, so the result is reused until then.
+		chart = latest_chart(
+			store,
+			genre,
+			chart_type,
+			skip_bundles,
+			skip_unknown,
+			at,
+		)
+		if chart is None:
+			raise CommandError("No charts found.")
 
-		filtered_entries = entries
-		if skip_bundles:
-			filtered_entries = [e for e in filtered_entries if not e.application.is_bundle]
-		if skip_unknown:
-			filtered_entries = [e for e in filtered_entries if e.application.is_known]
+		timestamp, filtered_entries = chart.timestamp, chart.rows
 
 		if output_list:
 			for entry in filtered_entries:
-				self.echo(str(entry.application.itunes_id))
+				self.echo(str(entry.app_id))
 		elif output_json:
 			result = {
-				'type': chart.chart_type.to_api(),
+				'type': chart_type.to_api(),
 				'genre': genre.itunes_id,
 				'store': store.country,
-				'timestamp': str(chart.timestamp),
+				'timestamp': str(timestamp),
 				'entries': [
 					{
 						'position': entry.position + 1,
-						'app_id': entry.application.itunes_id,
+						'app_id': entry.app_id,
 					}
 					for entry in filtered_entries
 				]
@@ -145,11 +207,61 @@ class Command(CoreCommand):
 			self.head("Store", str(store))
 			self.head("Genre", str(genre))
 			self.head("Type", " " + CHART_CHOICES[chart_type])
-			self.head("State", str(chart.timestamp))
+			self.head("State", str(timestamp))
 			self.secho("")
 			self.secho(f"Pos {'ID':<11s} {'Bundle ID':<50s} Name", fg='white', bold=True)
 			for pos, entry in enumerate(filtered_entries):
-				app = entry.application
-				bundle_id = self.display(app.bundle_identifier)
-				name = self.display(app.name)
-				self.secho(f"{pos+1:3d} {app.itunes_id:11d} {bundle_id:50s} {name:s}")
+				bundle_id = self.display(entry.bundle_identifier)
+				name = self.display(entry.name)
+				self.secho(f"{pos+1:3d} {entry.app_id:11d} {bundle_id:50s} {name:s}")
+
+	def output_history(
+		self,
+		rows: List[HistoryRow],
+		genre: Genre,
+		store: AppStore,
+		chart_type: ChartType,
+		output_json: bool,
+	):
+		if not rows:
+			raise CommandError("No charts found.")
+
+		if output_json:
+			result = {
+				'type': chart_type.to_api(),
+				'genre': genre.itunes_id,
+				'store': store.country,
+				'entries': [
+					{
+						'timestamp': str(row.timestamp),
+						'position': row.position + 1,
+						'app_id': row.app_id,
+						'movement': row.movement,
+						'entered': row.entered,
+						'exited': row.exited,
+					}
+					for row in rows
+				]
+			}
+			self.echo(json.dumps(result, separators=(',', ':')))
+			return
+
+		self.head("Store", str(store))
+		self.head("Genre", str(genre))
+		self.head("Type", " " + CHART_CHOICES[chart_type])
+		application_id: Optional[int] = None
+		for row in rows:
+			if row.app_id != application_id:
+				application_id = row.app_id
+				bundle_id = self.display(row.bundle_identifier)
+				name = self.display(row.name)
+				self.secho("")
+				self.secho(f"{application_id:d} {bundle_id:s} {name:s}", fg='white', bold=True)
+			if row.entered:
+				change = "new"
+			elif row.movement is None:
+				change = ""
+			else:
+				change = f"{row.movement:+d}" if row.movement else "="
+			note = " (exited)" if row.exited else ""
+			self.secho(f"{str(row.timestamp):32s} {row.position+1:3d} {change:>4s}{note:s}")
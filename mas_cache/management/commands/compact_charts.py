@@ -0,0 +1,255 @@
+import re
+import time
+
+from datetime import timedelta
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.core.management import CommandError, CommandParser
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import datetime, now, utc
+
+from core.management import CoreCommand
+from mas_cache import results
+from mas_cache.management import AppStoreType, GenreType
+from mas_cache.models import AppStore, Chart, ChartEntry, ChartType, Genre
+
+
+DEFAULT_POLICY = '7d=all,90d=1h,1d'
+
+BATCH_SIZE = 100
+
+UNITS = {
+	'm': timedelta(minutes=1),
+	'h': timedelta(hours=1),
+	'd': timedelta(days=1),
+	'w': timedelta(weeks=1),
+}
+
+EPOCH = datetime(1970, 1, 1, tzinfo=utc)
+
+
+class Tier(NamedTuple):
+	age: Optional[timedelta]  # Applies to charts younger than this, None for all older charts
+	interval: Optional[timedelta]  # One chart is kept per interval, None keeps all charts
+
+
+def DurationType(value: str) -> timedelta:
+	match = re.fullmatch(r'(\d+)([mhdw])', value.strip())
+	if match is None or int(match[1]) == 0:
+		raise ValueError
+	return int(match[1]) * UNITS[match[2]]
+
+
+def PolicyType(value: str) -> List[Tier]:
+	policy: List[Tier] = []
+	for tier in value.split(','):
+		age_value, _, interval_value = tier.rpartition('=')
+		age = DurationType(age_value) if age_value else None
+		# Tiers are ordered by age and only the last one may omit it.
+		previous = policy[-1].age if policy else timedelta(0)
+		if previous is None or (age is not None and age <= previous):
+			raise ValueError
+		interval = None if interval_value.strip() == 'all' else DurationType(interval_value)
+		policy.append(Tier(age, interval))
+	return policy
+
+
+class Command(CoreCommand):
+
+	help = """
+		Compact the stored charts according to a retention policy. Consecutive
+		charts with identical entries are collapsed into the first one, and
+		older charts are thinned out, e. g., to one chart per hour or day. The
+		latest chart of each store, genre, and chart type is always kept.
+		Charts are deleted in batches, each in its own transaction, so that the
+		command can run while the database is in use. Note that deleted charts
+		are stored again when their cache entries are scanned with --full.
+	"""
+
+	def add_arguments(self, parser: CommandParser):
+		parser.add_argument(
+			'-p', '--policy',
+			type=PolicyType,
+			default=DEFAULT_POLICY,
+			help=f"""
+				The retention policy as comma-separated tiers AGE=INTERVAL
+				ordered by age, e. g., 7d=all,90d=1h,1d. Charts younger than AGE
+				are thinned out to one chart per INTERVAL, or not at all for
+				"all". Durations are given in minutes (m), hours (h), days (d),
+				or weeks (w). The last tier may omit the age to apply to all
+				older charts, otherwise older charts are deleted. Intervals are
+				aligned to UTC. (default: {DEFAULT_POLICY})
+			""",
+		)
+		parser.add_argument(
+			'-s', '--store',
+			type=AppStoreType,
+			help="""
+				Only compact charts of a specific store, specified by the country
+				code, e. g., us or de. (default: all stores)
+			""",
+		)
+		parser.add_argument(
+			'-g', '--genre',
+			type=GenreType,
+			help="""
+				Only compact charts of a specific genre, specified by its iTunes
+				genre identifier. (default: all genres)
+			""",
+		)
+		parser.add_argument(
+			'--batch-size',
+			type=int,
+			default=BATCH_SIZE,
+			help=f"""
+				The number of charts read at once. The charts of a batch that
+				are deleted are deleted in a single transaction. (default:
+				{BATCH_SIZE})
+			""",
+		)
+		parser.add_argument(
+			'--pause',
+			type=float,
+			default=0.0,
+			metavar='SECONDS',
+			help="""
+				Pause after each transaction to reduce the load on a live
+				database. (default: 0)
+			""",
+		)
+		parser.add_argument(
+			'-n', '--dry-run',
+			action='store_true',
+			help="""
+				Only report how many charts would be deleted.
+			""",
+		)
+
+	def tier(self, policy: List[Tier], age: timedelta) -> Optional[Tier]:
+		"""
+		Return the tier of a chart of the given age, or None if the chart is
+		older than the policy.
+		"""
+
+		for tier in policy:
+			if tier.age is None or age < tier.age:
+				return tier
+		return None
+
+	def compact(
+		self,
+		store_id: str,
+		genre_id: int,
+		chart_type: ChartType,
+		policy: List[Tier],
+		batch_size: int,
+		pause: float,
+		dry_run: bool,
+	) -> Tuple[int, int]:
+		"""
+		Compact the charts of a single series and return the number of kept
+		and deleted charts. Charts are read in batches ordered by timestamp, so
+		that only the applications of the last kept chart are held across
+		batches.
+		"""
+
+		charts = Chart.objects.filter(store_id=store_id, genre_id=genre_id, chart_type=chart_type)
+		latest = charts.order_by('-timestamp').values_list('pk', flat=True).first()
+		reference = now()
+
+		kept = deleted = 0
+		previous: Optional[bytes] = None  # Applications of the last kept chart
+		previous_bucket: Optional[Tuple[Tier, int]] = None
+		after: Optional[Tuple[int, datetime]] = None
+		while True:
+			with self.phase('read'):
+				batch = charts.order_by('timestamp', 'pk')
+				if after is not None:
+					pk, timestamp = after
+					batch = batch.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk))
+				rows: List[Tuple[int, datetime, bytes]] = list(
+					batch.values_list('pk', 'timestamp', 'packed_app_ids')[:batch_size]
+				)
+				if not rows:
+					break
+				after = rows[-1][:2]
+
+			removed: List[int] = []
+			for pk, timestamp, packed_app_ids in rows:
+				app_ids = bytes(packed_app_ids)
+				tier = self.tier(policy, reference - timestamp)
+				bucket: Optional[Tuple[Tier, int]] = None
+				if tier is not None and tier.interval is not None:
+					bucket = tier, (timestamp - EPOCH) // tier.interval
+				if pk != latest and (
+					tier is None
+					or app_ids == previous
+					or (bucket is not None and bucket == previous_bucket)
+				):
+					removed.append(pk)
+					continue
+				kept += 1
+				previous = app_ids
+				previous_bucket = bucket
+
+			deleted += len(removed)
+			self.count('charts', len(rows))
+			if not removed or dry_run:
+				continue
+
+			with self.phase('delete'), transaction.atomic():
+				ChartEntry.objects.filter(
+					chart__in=removed,
+					timestamp__gte=rows[0][1],
+					timestamp__lte=rows[-1][1],
+				).delete()
+				Chart.objects.filter(pk__in=removed).delete()
+				results.invalidate()
+			self.count('deleted', len(removed))
+			if pause:
+				time.sleep(pause)
+
+		return kept, deleted
+
+	def handle(self, *args, **options):
+		policy: List[Tier] = options['policy']
+		store: Optional[AppStore] = options['store']
+		genre: Optional[Genre] = options['genre']
+		batch_size: int = options['batch_size']
+		pause: float = options['pause']
+		dry_run: bool = options['dry_run']
+
+		if batch_size < 1:
+			raise CommandError("The batch size needs to be positive.")
+		if pause < 0:
+			raise CommandError("The pause needs to be non-negative.")
+
+		charts = Chart.objects.all()
+		if store is not None:
+			charts = charts.filter(store=store)
+		if genre is not None:
+			charts = charts.filter(genre=genre)
+		series = charts.order_by('store', 'genre', 'chart_type').values_list(
+			'store', 'genre', 'chart_type',
+		).distinct()
+
+		total_kept = total_deleted = 0
+		for store_id, genre_id, chart_type in series:
+			kept, deleted = self.compact(
+				store_id,
+				genre_id,
+				ChartType(chart_type),
+				policy,
+				batch_size,
+				pause,
+				dry_run,
+			)
+			total_kept += kept
+			total_deleted += deleted
+			if deleted:
+				self.echo(f"{store_id} {genre_id} {ChartType(chart_type).label}: kept {kept}, {'would delete' if dry_run else 'deleted'} {deleted}")
+
+		self.success(
+			f"Kept {total_kept} charts, {'would delete' if dry_run else 'deleted'} {total_deleted} charts."
+		)
@@ -0,0 +1,204 @@
+import os
+
+from itertools import islice
+from typing import Any, Callable, Iterator, Optional, Sequence, Tuple
+
+from django.core.management import CommandError, CommandParser
+from django.db.models import QuerySet
+from django.utils.timezone import datetime
+
+from core.management import CoreCommand
+from mas_cache.management import AppStoreType, GenreType
+from mas_cache.models import (
+	AppStore,
+	Chart,
+	ChartType,
+	Genre,
+	LatestMetadata,
+	unpack_app_ids,
+)
+
+
+CHUNK_SIZE = 10000
+
+# Column name, field lookup (for rows selected by `select`), Arrow data type,
+# and conversion of the value
+Column = Tuple[str, Optional[str], Any, Optional[Callable[[Any], Any]]]
+
+
+class Command(CoreCommand):
+
+	help = """
+		Export charts, chart entries, and the latest metadata of applications
+		as Parquet files for analysis, e. g., with pandas. Rows are streamed
+		from the database, so that memory usage does not depend on the number
+		of rows. Requires pyarrow, which can be installed along with this
+		package by: pip install mas-cache[export]
+	"""
+
+	def add_arguments(self, parser: CommandParser):
+		parser.add_argument(
+			'output',
+			help="""
+				The directory to write charts.parquet, chart_entries.parquet,
+				and applications.parquet to. It is created if necessary and
+				existing files are overwritten.
+			""",
+		)
+		parser.add_argument(
+			'-s', '--store',
+			type=AppStoreType,
+			help="""
+				Only export charts and metadata of a specific store, specified
+				by the country code, e. g., us or de. (default: all stores)
+			""",
+		)
+		parser.add_argument(
+			'-g', '--genre',
+			type=GenreType,
+			help="""
+				Only export charts of a specific genre, specified by its iTunes
+				genre identifier. (default: all genres)
+			""",
+		)
+		parser.add_argument(
+			'--chunk-size',
+			type=int,
+			default=CHUNK_SIZE,
+			help=f"""
+				The number of rows fetched from the database and written to
+				the files at once. (default: {CHUNK_SIZE})
+			""",
+		)
+
+	def select(
+		self,
+		queryset: QuerySet,
+		columns: Sequence[Column],
+		chunk_size: int,
+	) -> Iterator[Tuple[Any, ...]]:
+		"""
+		Stream the values of the columns from `queryset`.
+		"""
+
+		return queryset.values_list(
+			*(lookup for _, lookup, _, _ in columns),
+		).iterator(chunk_size=chunk_size)
+
+	def chart_entries(
+		self,
+		charts: QuerySet,
+		chunk_size: int,
+	) -> Iterator[Tuple[int, datetime, int, int]]:
+		"""
+		Stream the entries of charts from their packed applications, since the
+		chart entries might not be stored, see `CHART_ENTRIES`.
+		"""
+
+		for chart_id, timestamp, packed_app_ids in charts.values_list(
+			'pk',
+			'timestamp',
+			'packed_app_ids',
+		).iterator(chunk_size=chunk_size):
+			for position, app_id in enumerate(unpack_app_ids(packed_app_ids)):
+				yield chart_id, timestamp, app_id, position
+
+	def write(
+		self,
+		filename: str,
+		columns: Sequence[Column],
+		rows: Iterator[Tuple[Any, ...]],
+		chunk_size: int,
+	) -> int:
+		"""
+		Write rows to a Parquet file, one row group per chunk, and return the
+		number of rows written.
+		"""
+
+		import pyarrow
+		import pyarrow.parquet
+
+		schema = pyarrow.schema([(name, data_type) for name, _, data_type, _ in columns])
+
+		count = 0
+		with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+			while True:
+				chunk = list(islice(rows, chunk_size))
+				if not chunk:
+					break
+				arrays = []
+				for values, (_, _, data_type, convert) in zip(zip(*chunk), columns):
+					if convert is not None:
+						values = tuple(map(convert, values))
+					arrays.append(pyarrow.array(values, type=data_type))
+				writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+				count += len(chunk)
+
+		return count
+
+	def handle(self, *args, **options):
+		output: str = options['output']
+		store: Optional[AppStore] = options['store']
+		genre: Optional[Genre] = options['genre']
+		chunk_size: int = options['chunk_size']
+
+		if chunk_size < 1:
+			raise CommandError("The chunk size needs to be positive.")
+
+		try:
+			import pyarrow
+		except ImportError:
+			raise CommandError("Exporting requires pyarrow: pip install mas-cache[export]")
+
+		charts = Chart.objects.order_by('pk')
+		latest = LatestMetadata.objects.order_by('application', 'store')
+		if store is not None:
+			charts = charts.filter(store=store)
+			latest = latest.filter(store=store)
+		if genre is not None:
+			charts = charts.filter(genre=genre)
+
+		os.makedirs(output, exist_ok=True)
+
+		timestamp = pyarrow.timestamp('us', tz='UTC')
+
+		columns: Sequence[Column] = (
+			('chart_id', 'pk', pyarrow.int64(), None),
+			('genre', 'genre', pyarrow.int64(), None),
+			('store', 'store__country', pyarrow.string(), None),
+			('chart_type', 'chart_type', pyarrow.string(), ChartType.to_api),
+			('timestamp', 'timestamp', timestamp, None),
+		)
+		count = self.write(
+			os.path.join(output, 'charts.parquet'),
+			columns,
+			self.select(charts, columns, chunk_size),
+			chunk_size,
+		)
+		self.success(f"Exported {count} charts.")
+
+		# Positions start at 1, as in the output of the charts command.
+		count = self.write(os.path.join(output, 'chart_entries.parquet'), (
+			('chart_id', None, pyarrow.int64(), None),
+			('timestamp', None, timestamp, None),
+			('app_id', None, pyarrow.int64(), None),
+			('position', None, pyarrow.int16(), lambda position: position + 1),
+		), self.chart_entries(charts, chunk_size), chunk_size)
+		self.success(f"Exported {count} chart entries.")
+
+		columns = (
+			('app_id', 'application', pyarrow.int64(), None),
+			('store', 'store__country', pyarrow.string(), None),
+			('timestamp', 'timestamp', timestamp, None),
+			('name', 'name', pyarrow.string(), None),
+			('bundle_identifier', 'bundle_identifier', pyarrow.string(), None),
+			('app_type', 'app_type', pyarrow.string(), None),
+			('is_known', 'is_known', pyarrow.bool_(), None),
+		)
+		count = self.write(
+			os.path.join(output, 'applications.parquet'),
+			columns,
+			self.select(latest, columns, chunk_size),
+			chunk_size,
+		)
+		self.success(f"Exported {count} applications.")
@@ -0,0 +1,99 @@
+import os
+
+from django.core.management import CommandError, CommandParser
+
+from core.management import CoreCommand
+from mas_cache.synthetic import Sizes, generate
+
+
+class Command(CoreCommand):
+
+	help = """
+		Generate a synthetic cache of the Mac App Store (MAS) with random
+		applications, search results, charts, and editorial content. The
+		cache can be scanned like a snapshot of a real cache, e. g., for
+		testing or benchmarking on other platforms than macOS.
+	"""
+
+	def add_arguments(self, parser: CommandParser):
+		defaults = Sizes()
+		parser.add_argument(
+			'output',
+			help="""
+				The directory to create the Cache.db and the fsCachedData
+				directory in. It must not contain a cache yet.
+			""",
+		)
+		parser.add_argument(
+			'--apps',
+			type=int,
+			default=defaults.apps,
+			help=f"""
+				The number of distinct applications. (default: {defaults.apps})
+			""",
+		)
+		parser.add_argument(
+			'--genres',
+			type=int,
+			default=defaults.genres,
+			help=f"""
+				The number of genres with charts besides the App Store itself.
+				(default: {defaults.genres})
+			""",
+		)
+		parser.add_argument(
+			'--chart-size',
+			type=int,
+			default=defaults.chart_size,
+			help=f"""
+				The number of applications per chart. (default: {defaults.chart_size})
+			""",
+		)
+		parser.add_argument(
+			'--searches',
+			type=int,
+			default=defaults.searches,
+			help=f"""
+				The number of search results. (default: {defaults.searches})
+			""",
+		)
+		parser.add_argument(
+			'--rooms',
+			type=int,
+			default=defaults.rooms,
+			help=f"""
+				The number of editorial rooms. (default: {defaults.rooms})
+			""",
+		)
+		parser.add_argument(
+			'--country',
+			default='us',
+			help="""
+				The country code of the store. (default: us)
+			""",
+		)
+		parser.add_argument(
+			'--seed',
+			type=int,
+			default=0,
+			help="""
+				The seed for the random generator. The same seed and sizes
+				yield the same cache. (default: 0)
+			""",
+		)
+
+	def handle(self, *args, **options):
+		output: str = options['output']
+
+		if os.path.exists(os.path.join(output, 'Cache.db')):
+			raise CommandError(f"Cache already exists: {output}")
+
+		sizes = Sizes(
+			apps=options['apps'],
+			genres=options['genres'],
+			chart_size=options['chart_size'],
+			searches=options['searches'],
+			rooms=options['rooms'],
+		)
+		generate(output, sizes, country=options['country'], seed=options['seed'])
+		self.success(f"Successfully generated cache: {output}")
@@ -1,12 +1,19 @@
 import json
 
-from typing import Any, Dict, Optional
+from typing import List, Optional
 
 from django.core.management import CommandError, CommandParser
+from django.db.models import TextField
+from django.db.models.functions import Cast
+from django.utils.timezone import datetime
 
 from core.management import CoreCommand
-from mas_cache.management import AppStoreType
+from mas_cache.management import AppStoreType, TimestampType
 from mas_cache.models import Application, AppStore, Metadata
+from mas_cache.results import cached, default_store, result_key
+
+
+DUMP_CHUNK_SIZE = 1000
 
 
 class Command(CoreCommand):
@@ -17,58 +24,145 @@ class Command(CoreCommand):
 		formatted the same way as the MAS uses it internally. This might be
 		subject to change. Metadata can be retrieved officially via the iTunes
 		Search API: https://itunes.apple.com/lookup?id=<app_id>. Note that the
-		formats are different.
+		formats are different. Alternatively, the whole history of metadata can
+		be dumped as newline-delimited JSON.
 	"""
 
 	def add_arguments(self, parser: CommandParser):
 		parser.add_argument(
 			'-s', '--store',
 			type=AppStoreType,
-			default=AppStore.objects.first(),
 			help="""
-				Output charts for a specific store. Since in most cases only a
-				single store is present, the first one found in the database is
-				used by default. The store is specified by the country code,
-				e. g., us or de.
+				Output metadata for a specific store. Since in most cases only
+				a single store is present, the first one found in the database
+				is used by default. The store is specified by the country code,
+				e. g., us or de. When dumping, metadata of all stores is
+				included by default.
 			""",
 		)
-		parser.add_argument(
+		apps = parser.add_mutually_exclusive_group()
+		apps.add_argument(
 			'app',
 			type=int,
+			nargs='*',
+			default=[],
 			help="""
 				The ID of the application, for which metadata should be returned.
+				When dumping, multiple IDs can be given to restrict the dump to
+				these applications.
+			""",
+		)
+		apps.add_argument(
+			'-b', '--bundle-id',
+			help="""
+				The bundle identifier of the application, for which metadata
+				should be returned. The application is looked up by the bundle
+				identifier of its latest metadata in the given store.
+			""",
+		)
+		parser.add_argument(
+			'--dump',
+			action='store_true',
+			help="""
+				Dump all stored metadata, one JSON object per line, in the
+				order in which it was stored. Besides the store, source,
+				timestamp, and data, each line contains the ID of the
+				metadata, which can be passed to --after-id to resume an
+				interrupted dump.
+			""",
+		)
+		parser.add_argument(
+			'--since',
+			type=TimestampType,
+			metavar='TIMESTAMP',
+			help="""
+				Only dump metadata retrieved at or after the given point in
+				time, e. g., 2020-06-01 or 2020-06-01T12:00:00+02:00.
+			""",
+		)
+		parser.add_argument(
+			'--until',
+			type=TimestampType,
+			metavar='TIMESTAMP',
+			help="""
+				Only dump metadata retrieved at or before the given point in
+				time.
+			""",
+		)
+		parser.add_argument(
+			'--after-id',
+			type=int,
+			metavar='ID',
+			help="""
+				Only dump metadata with an ID greater than the given one.
 			""",
 		)
 
-	def handle(self, *args, **options):
-		store: AppStore = options['store']
-		app_id: int = options['app']
-		app = Application.objects.get(itunes_id=app_id)
-
-		metadatas = Metadata.objects.filter(
-			application=app,
+	def resolve_bundle_id(self, bundle_id: str, store: Optional[AppStore]) -> int:
+		app_ids = list(Application.objects.with_bundle_identifier(
+			bundle_id,
 			store=store,
-			data__isnull=False,
-		).order_by('-timestamp')
-
-		metadata: Optional[Metadata] = None
-		for current in metadatas:
-			data: Dict[str, Any] = current.data
-
-			# Sometimes applications are fetched lazily by the MAS, meaning that
-			# there is only a placeholder, but no actual data.
-			if 'attributes' not in data:
-				continue
-
-			if data.get('type', None) == 'app-bundles':
-				raise CommandError(f"ID belongs to an application bundle: {app}")
-
-			metadata = current
-			break
-
+		).values_list('itunes_id', flat=True)[:2])
+		if not app_ids:
+			raise CommandError(f"No application with bundle ID: {bundle_id}")
+		if 1 < len(app_ids):
+			raise CommandError(f"Bundle ID is ambiguous: {bundle_id}")
+		return app_ids[0]
+
+	def dump(
+		self,
+		store: Optional[AppStore],
+		app_ids: List[int],
+		since: Optional[datetime],
+		until: Optional[datetime],
+		after_id: Optional[int],
+	):
+		metadatas = Metadata.objects.order_by('pk')
+		if store is not None:
+			metadatas = metadatas.filter(store=store)
+		if app_ids:
+			metadatas = metadatas.filter(application__in=app_ids)
+		if since is not None:
+			metadatas = metadatas.filter(timestamp__gte=since)
+		if until is not None:
+			metadatas = metadatas.filter(timestamp__lte=until)
+		if after_id is not None:
+			metadatas = metadatas.filter(pk__gt=after_id)
+
+		# The data is passed through as serialized by the database instead of
+		# decoding and encoding it again. Rows are fetched in chunks from a
+		# server-side cursor, so that memory usage stays constant.
+		rows = metadatas.values_list(
+			'pk',
+			'application',
+			'store__country',
+			'source',
+			'timestamp',
+			Cast('blob__data', TextField()),
+		).iterator(chunk_size=DUMP_CHUNK_SIZE)
+
+		for pk, app_id, country, source, timestamp, data in rows:
+			self.echo(
+				f'{{"id":{pk:d},"app_id":{app_id:d},'
+				f'"store":{json.dumps(country)},'
+				f'"source":{json.dumps(source)},'
+				f'"timestamp":"{timestamp}",'
+				f'"data":{data}}}'
+			)
+
+	def latest(self, store: AppStore, app_id: int) -> str:
+		try:
+			app = Application.objects.get(itunes_id=app_id)
+		except Application.DoesNotExist:
+			raise CommandError(f"Unknown application: {app_id}")
+
+		metadata = app.latest_known_metadata(store)
 		if metadata is None:
 			raise CommandError(f"No metadata for app: {app}")
 
+		if metadata.data.get('type', None) == 'app-bundles':
+			raise CommandError(f"ID belongs to an application bundle: {app}")
+
 		result = {
 			'store': store.country,
 			'source': metadata.source,
@@ -76,4 +170,39 @@ class Command(CoreCommand):
 			'data': metadata.data,
 		}
 
-		self.echo(json.dumps(result, separators=(',', ':')))
+		return json.dumps(result, separators=(',', ':'))
+
+	def handle(self, *args, **options):
+		store: Optional[AppStore] = options['store']
+		app_ids: List[int] = options['app']
+		bundle_id: Optional[str] = options['bundle_id']
+		since: Optional[datetime] = options['since']
+		until: Optional[datetime] = options['until']
+		after_id: Optional[int] = options['after_id']
+
+		if options['dump']:
+			if bundle_id is not None:
+				app_ids = [self.resolve_bundle_id(bundle_id, store)]
+			self.dump(store, app_ids, since, until, after_id)
+			return
+
+		if since is not None or until is not None or after_id is not None:
+			raise CommandError("--since, --until, and --after-id require --dump.")
+
+		if store is None:
+			store = default_store()
+			if store is None:
+				raise CommandError("No stores found.")
+
+		if bundle_id is not None:
+			app_id = self.resolve_bundle_id(bundle_id, store)
+		elif len(app_ids) == 1:
+			app_id = app_ids[0]
+		else:
+			raise CommandError("Expecting either a single application ID or --bundle-id.")
+
+		# Metadata only changes when scanning, so the result is reused until then.
+		self.echo(cached(
+			result_key('metadata', store.pk, app_id),
+			lambda: self.latest(store, app_id),
+		))
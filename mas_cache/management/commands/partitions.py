@@ -0,0 +1,120 @@
+from typing import List, Optional
+
+from django.core.management import CommandError, CommandParser
+from django.db import transaction
+from django.utils.timezone import datetime, now
+
+from core.management import CoreCommand
+from mas_cache import partitions, results
+from mas_cache.management import TimestampType
+
+
+class Command(CoreCommand):
+
+	help = """
+		Manage the monthly partitions of the metadata and chart entries on
+		PostgreSQL. Partitions for the current and the following months are
+		created, old partitions can be detached as archive tables or dropped,
+		and all partitions are listed afterwards. Run it regularly, e. g.,
+		monthly, once partitioning has been enabled.
+	"""
+
+	def add_arguments(self, parser: CommandParser):
+		parser.add_argument(
+			'--enable',
+			action='store_true',
+			help="""
+				Convert the tables into partitioned tables. All rows are copied,
+				so this takes a while for large tables, during which the tables
+				are locked.
+			""",
+		)
+		parser.add_argument(
+			'--ahead',
+			type=int,
+			default=3,
+			metavar='MONTHS',
+			help="""
+				The number of months after the current one to create partitions
+				for. Partitions are also created by scan if needed, but creating
+				them ahead of time avoids locking the tables while scanning.
+				(default: 3)
+			""",
+		)
+		parser.add_argument(
+			'--detach',
+			type=TimestampType,
+			metavar='TIMESTAMP',
+			help="""
+				Detach partitions that only contain rows before this point in
+				time, e. g., 2020-01-01. Detached partitions are kept as
+				standalone archive tables without foreign keys. Charts are kept,
+				since they store their applications themselves, and partitions
+				with the latest metadata of an application are kept as well.
+			""",
+		)
+		parser.add_argument(
+			'--drop',
+			action='store_true',
+			help="""
+				Drop detached partitions instead of archiving them.
+			""",
+		)
+
+	def detach(self, before: datetime, drop: bool):
+		# Charts are kept, since they store their applications themselves and
+		# are needed to interpret archived entries.
+		for table in partitions.TABLES:
+			for partition in partitions.partitions(table):
+				if before < partition.end:
+					break
+				try:
+					partitions.detach(table, partition, drop)
+				except partitions.PartitionError as e:
+					self.warn(f"Kept partition: {e}")
+					continue
+				self.success(f"{'Dropped' if drop else 'Detached'} partition: {partition.name}")
+
+	def handle(self, *args, **options):
+		enable: bool = options['enable']
+		ahead: int = options['ahead']
+		before: Optional[datetime] = options['detach']
+		drop: bool = options['drop']
+
+		if not partitions.is_supported():
+			raise CommandError("Partitioning requires PostgreSQL.")
+		if ahead < 0:
+			raise CommandError("The number of months needs to be non-negative.")
+		if drop and before is None:
+			raise CommandError("--drop requires --detach.")
+
+		tables = partitions.partitioned_tables()
+		if enable:
+			for table in partitions.TABLES:
+				if table.table in tables:
+					continue
+				partitions.enable(table, ahead)
+				self.success(f"Partitioned table: {table.table}")
+			tables = partitions.partitioned_tables()
+		if not tables:
+			raise CommandError("Partitioning is not enabled, see --enable.")
+
+		month = partitions.month_of(now())
+		for _ in range(ahead + 1):
+			for table in partitions.TABLES:
+				if month not in tables.get(table.table, set()):
+					partitions.create_partition(table, month)
+					self.success(f"Created partition: {partitions.partition_name(table, month)}")
+			month = partitions.next_month(month)
+
+		if before is not None:
+			with transaction.atomic():
+				self.detach(before, drop)
+				results.invalidate()
+
+		for table in partitions.TABLES:
+			self.secho("")
+			self.secho(table.table, fg='white', bold=True)
+			rows: List[partitions.Partition] = partitions.partitions(table)
+			for partition in rows:
+				self.secho(f"{partition.name:40s} {partition.start:%Y-%m-%d} - {partition.end:%Y-%m-%d} {partition.rows:>12d} rows")
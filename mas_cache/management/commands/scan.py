@@ -1,20 +1,32 @@
-import difflib
 import json
 import os
 import sqlite3
 import sys
+import time
 
-from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
-from urllib.parse import parse_qs, urlparse
+from contextlib import ExitStack
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.management import CommandError, CommandParser
-from django.db import transaction
+from django.db import close_old_connections, connection, connections, transaction
 from django.utils import timezone
 from django.utils.timezone import datetime
 
 from core.management import CoreCommand
+from mas_cache.cache import (
+	Cache,
+	CacheEntry,
+	Resource,
+	find_cache_dir,
+	init_worker,
+	load_resource,
+	open_snapshot,
+	parse_resource,
+)
+from mas_cache import results
 from mas_cache.models import (
 	AppStore,
 	Application,
@@ -22,11 +34,18 @@ from mas_cache.models import (
 	ChartEntry,
 	ChartType,
 	Genre,
+	LatestMetadata,
 	Metadata,
+	MetadataBlob,
+	ScannedResponse,
+	content_digest,
+	pack_app_ids,
 )
+from mas_cache.partitions import Partitions
 
 
-ReceiverData = Union[bytes, str]
+# Number of applications that are added with a single bulk statement
+BATCH_SIZE = 100
 
 
 class Command(CoreCommand):
@@ -41,50 +60,43 @@ class Command(CoreCommand):
 		super().__init__(*args, **kwargs)
 
 		self.container = os.path.expanduser('~/Library/Containers/com.apple.appstore/Data')
-		self._cache_db: Optional[sqlite3.Connection] = None
+		self._cache: Optional[Cache] = None
 		self.auto_update = False
+		self.partitions = Partitions()
 
 	def __del__(self):
-		if self._cache_db:
-			self._cache_db.close()
+		if self._cache:
+			self._cache.close()
 
 	@property
 	def cache_dir(self) -> str:
 		return os.path.join(self.container, 'Library/Caches/com.apple.appstore')
 
 	@property
-	def cache_data_dir(self) -> str:
-		return os.path.join(self.cache_dir, 'fsCachedData')
-
-	@property
-	def cache_db(self) -> sqlite3.Connection:
-		if self._cache_db is None:
-			fn = os.path.join(self.cache_dir, 'Cache.db')
-			self._cache_db = sqlite3.connect(fn)
-		return self._cache_db
+	def cache(self) -> Cache:
+		if self._cache is None:
+			self._cache = Cache(self.cache_dir)
+		return self._cache
+
+	def add_blob(self, data: Dict[str, Any]) -> MetadataBlob:
+		blob = MetadataBlob.from_data(data)
+		blob, _ = MetadataBlob.objects.get_or_create(
+			digest=blob.digest,
+			defaults={'data': blob.data},
+		)
+		return blob
 
-	def get_cached_resource(
+	def add_application_data(
 		self,
-		receiver_data: ReceiverData,
-		should_be_on_fs: bool,
-	) -> Dict[str, Any]:
-		if isinstance(receiver_data, str):
-			resource_id: str = receiver_data
-
-			if not should_be_on_fs:
-				self.warn(f"Resource might not be cached, trying to locate anyway: {resource_id}")
-
-			resource_fn = os.path.join(self.cache_data_dir, resource_id)
-
-			with open(resource_fn, 'rb') as fp:
-				return json.load(fp)
-
-		assert isinstance(receiver_data, bytes)
-
-		return json.loads(receiver_data.decode())
+		data: Dict[str, Any],
+		source: str,
+		timestamp: datetime,
+		store: AppStore,
+	):
+		with self.phase('application'), transaction.atomic():
+			self._add_application_data(data, source, timestamp, store)
 
-	@transaction.atomic
-	def add_application_data(
+	def _add_application_data(
 		self,
 		data: Dict[str, Any],
 		source: str,
@@ -96,23 +108,24 @@ class Command(CoreCommand):
 
 		app, app_created = Application.objects.get_or_create(itunes_id=app_id)
 
-		metadatas = Metadata.objects.filter(
+		metadatas = list(Metadata.objects.filter(
 			application=app,
 			store=store,
 			source=source,
 			timestamp=timestamp,
-		)
-		if metadatas.exists():
-			assert metadatas.count() == 1
-			metadata = metadatas.first()
+		)[:2])
+		if metadatas:
+			assert len(metadatas) == 1
+			metadata = metadatas[0]
 
-			existing_data = json.dumps(metadata.data, sort_keys=True, indent=2).splitlines()
-			new_data = json.dumps(data, sort_keys=True, indent=2).splitlines()
-			if existing_data != new_data:
+			if metadata.digest != content_digest(data):
 				self.warn(f"Cached entries are different:\n  App: {app}\n  Store: {store}\n  Source: {source}\n  Timestamp: {timestamp}")
 				if self.auto_update:
 					answer = 'u'
 				else:
+					import difflib
+					existing_data = json.dumps(metadata.data, sort_keys=True, indent=2).splitlines()
+					new_data = json.dumps(data, sort_keys=True, indent=2).splitlines()
 					diff = difflib.ndiff(existing_data, new_data)
 					for line in diff:
 						if line.startswith('- '):
@@ -132,9 +145,10 @@ class Command(CoreCommand):
 							break
 						answer = input("Please select a valid option: ")
 				if answer == 'u':  # Update
-					metadata.data = data
+					metadata.blob = self.add_blob(data)
 					metadata.full_clean()
 					metadata.save()
+					LatestMetadata.objects.track([metadata])
 				elif answer == 'k':  # Keep
 					assert not app_created
 					return
@@ -148,14 +162,122 @@ class Command(CoreCommand):
 				store=store,
 				source=source,
 				timestamp=timestamp,
-				data=data,
+				blob=self.add_blob(data),
 			)
 			metadata.full_clean()
 			metadata.save()
+			LatestMetadata.objects.track([metadata])
 
 		if app_created:
 			self.success(f"Added new application: {app}")
 
+	@transaction.atomic
+	def add_applications_data(
+		self,
+		apps: Iterable[Dict[str, Any]],
+		source: str,
+		timestamp: datetime,
+		store: AppStore,
+	):
+		"""
+		Add the applications of a single resource in bulk. The applications are
+		consumed in batches of `BATCH_SIZE`, so that only a single batch needs to
+		be kept in memory. Existing applications and snapshots of a batch are
+		resolved with a single query each and missing rows are inserted with a
+		single statement each. Only snapshots that differ from the stored ones
+		and duplicate entries are handled individually by `add_application_data`.
+		"""
+
+		it = iter(apps)
+		while True:
+			# Applications are decoded lazily from the document.
+			with self.phase('decode'):
+				chunk = list(islice(it, BATCH_SIZE))
+			if not chunk:
+				break
+			self.count('applications', len(chunk))
+			with self.phase('applications'):
+				self._add_applications_batch(chunk, source, timestamp, store)
+
+	def _add_applications_batch(
+		self,
+		apps: List[Dict[str, Any]],
+		source: str,
+		timestamp: datetime,
+		store: AppStore,
+	):
+		batch: Dict[int, Dict[str, Any]] = {}
+		duplicates: List[Dict[str, Any]] = []
+		for data in apps:
+			assert 'id' in data
+			app_id = int(data['id'])
+			if app_id in batch:
+				duplicates.append(data)
+			else:
+				batch[app_id] = data
+
+		existing_apps = set(Application.objects.filter(
+			itunes_id__in=batch.keys(),
+		).values_list('itunes_id', flat=True))
+		existing_metadata = dict(Metadata.objects.filter(
+			application__in=batch.keys(),
+			store=store,
+			source=source,
+			timestamp=timestamp,
+		).values_list('application', 'blob'))
+		blobs = {
+			app_id: MetadataBlob.from_data(data)
+			for app_id, data in batch.items()
+		}
+
+		new_apps = [
+			Application(itunes_id=app_id)
+			for app_id in batch.keys()
+			if app_id not in existing_apps
+		]
+		new_metadata = [
+			Metadata(
+				application_id=app_id,
+				store=store,
+				source=source,
+				timestamp=timestamp,
+				blob=blobs[app_id],
+			)
+			for app_id in batch.keys()
+			if app_id not in existing_metadata
+		]
+		Application.objects.bulk_create(new_apps, ignore_conflicts=True)
+		MetadataBlob.objects.bulk_create(
+			{metadata.blob.digest: metadata.blob for metadata in new_metadata}.values(),
+			ignore_conflicts=True,
+		)
+		Metadata.objects.bulk_create(new_metadata)
+		if new_metadata and not connection.features.can_return_rows_from_bulk_insert:
+			# The primary keys of the inserted rows are not returned, e. g., by
+			# SQLite, so they are resolved with a single query.
+			pks = dict(Metadata.objects.filter(
+				application__in=[metadata.application_id for metadata in new_metadata],
+				store=store,
+				source=source,
+				timestamp=timestamp,
+			).values_list('application', 'pk'))
+			for metadata in new_metadata:
+				metadata.pk = pks[metadata.application_id]
+		LatestMetadata.objects.track(new_metadata)
+
+		for app_id, data in batch.items():
+			if app_id in existing_metadata and existing_metadata[app_id] != blobs[app_id].digest:
+				self.add_application_data(data, source, timestamp, store)
+
+		for data in duplicates:
+			self.add_application_data(data, source, timestamp, store)
+
+		# Applications are named after the data at hand, see `Application.__str__`,
+		# instead of querying their latest metadata one by one.
+		for app in new_apps:
+			name = batch[app.itunes_id].get('attributes', {}).get('name', None)
+			self.success(f"Added new application: {app.itunes_id if name is None else name}")
+
 	@transaction.atomic
 	def add_genre(
 		self,
@@ -185,112 +307,119 @@ class Command(CoreCommand):
 
 		return genre
 
-	def process_resource(self, resource: Dict[str, Any], source: str, timestamp: datetime):
-		# Deconstruct URL
-		url = urlparse(source)
-		path = Path(url.path)
-		assert 3 < len(path.parts), f"Unknown URL: {url}"
-		mode = path.parts[2]
-		country = path.parts[3]
+	@transaction.atomic
+	def add_chart(
+		self,
+		genre: Genre,
+		store: AppStore,
+		chart_type: ChartType,
+		timestamp: datetime,
+		app_ids: List[int],
+	) -> Chart:
+		"""
+		Add a chart with the given applications in order of their position. The
+		applications are resolved with a single query and all entries, unless
+		disabled by `CHART_ENTRIES`, are inserted with a single statement.
+		"""
+
+		apps = Application.objects.in_bulk(app_ids)
+		missing = set(app_ids) - apps.keys()
+		assert not missing, f"Unknown applications: {missing}"
+
+		chart = Chart(
+			genre=genre,
+			store=store,
+			chart_type=chart_type,
+			timestamp=timestamp,
+			packed_app_ids=pack_app_ids(app_ids),
+		)
+		chart.full_clean()
+		chart.save()
 
-		store, store_created = AppStore.objects.get_or_create(country=country)
+		if not settings.CHART_ENTRIES:
+			return chart
+
+		ChartEntry.objects.bulk_create([
+			ChartEntry(
+				chart=chart,
+				application=apps[app_id],
+				position=position,
+				timestamp=timestamp,
+			)
+			for position, app_id in enumerate(app_ids)
+		])
+
+		return chart
+
+	def store_resource(self, resource: Resource, timestamp: datetime):
+		for warning in resource.warnings:
+			self.warn(warning)
+
+		store, store_created = AppStore.objects.get_or_create(country=resource.country)
 		if store_created:
 			self.success(f"Added new store: {store}")
 
-		if mode == 'catalog':
-			# Deconstruct URL further
-			assert 4 < len(path.parts), f"Unknown URL: {url}"
-			sub_mode = path.parts[4]
-
-			if sub_mode in ['apps', 'contents']:
-				data = resource['data']
-				for app_data in data:
-					self.add_application_data(app_data, source, timestamp, store)
-			elif sub_mode == 'search':
-				data = resource['results']['search']['data']
-				for app_data in data:
-					self.add_application_data(app_data, source, timestamp, store)
-			elif sub_mode == 'charts':
-				# Extract genre
-				query = parse_qs(url.query)
-				assert 'genre' in query
-				assert len(query['genre']) == 1
-				genre = self.add_genre(int(query['genre'][0]))
-
-				# Split charts by type
-				charts_data = resource['results']['apps']
-				charts: Dict[ChartType, List[Dict[str, Any]]] = {}
-				for chart in charts_data:
-					chart_type = ChartType.from_api(chart['chart'])
-					charts[chart_type] = chart['data']
-
-				# Store apps. For some of them, the metadata has been prefetched.
-				for data in charts.values():
-					for app_data in data:
-						self.add_application_data(app_data, source, timestamp, store)
-
-				for chart_type, chart_data in charts.items():
-					# Check whether the chart is already known
-					if Chart.objects.filter(
-						genre=genre,
-						store=store,
-						chart_type=chart_type,
-						timestamp=timestamp,
-					).exists():
-						continue
-
-					with transaction.atomic():
-						chart = Chart(
-							genre=genre,
-							store=store,
-							chart_type=chart_type,
-							timestamp=timestamp,
-						)
-						chart.full_clean()
-						chart.save()
-
-						for position, app_data in enumerate(chart_data):
-							app_id = int(app_data['id'])
-							app = Application.objects.get(itunes_id=app_id)
-							entry = ChartEntry(
-								chart=chart,
-								application=app,
-								position=position,
-							)
-							entry.full_clean()
-							entry.save()
-					self.success(f"Successfully added chart: {chart}")
-			else:
-				assert False, f"Unhandled {mode} sub-mode: {sub_mode}"
-		elif mode == 'editorial':
-			assert 4 < len(path.parts)
-			sub_mode = path.parts[4]
-			if sub_mode == 'categories':
-				categories = resource['results']['categories']
-				for category in categories:
-					parent = self.add_genre(
-						itunes_id=int(category['genre']),
-						name=category['name'],
-					)
-					for child in category['children']:
-						self.add_genre(
-							itunes_id=int(child['genre']),
-							name=child['name'],
-							parent=parent,
-						)
-			else:
-				editorials: List[Dict[str, Any]] = resource['data']
-				for editorial in editorials:
-					editorial_type = editorial['type']
-					if editorial_type == 'groupings':
-						# TODO Handle groupings... apps are nested deep.
-						continue
-					assert editorial_type == 'rooms', source
-					data = editorial['relationships']['contents']['data']
-					for app_data in data:
-						self.add_application_data(app_data, source, timestamp, store)
-		else:
-			assert False, f"Unhandled mode: {mode}"
+		genres: Dict[int, Genre] = {}
+		with self.phase('genres'):
+			for record in resource.genres:
+				parent: Optional[Genre] = None
+				if record.parent is not None:
+					parent = genres[record.parent]
+				genres[record.itunes_id] = self.add_genre(
+					itunes_id=record.itunes_id,
+					name=record.name,
+					parent=parent,
+				)
+
+		charts = [
+			(ChartType.from_api(chart.chart_type), chart)
+			for chart in resource.charts
+		]
+
+		self.add_applications_data(resource.apps, resource.source, timestamp, store)
+
+		if not charts:
+			return
+
+		# Check which of the charts are already known
+		known_charts = set(Chart.objects.filter(
+			store=store,
+			timestamp=timestamp,
+		).values_list('genre', 'chart_type'))
+
+		for chart_type, chart in charts:
+			if (chart.genre, chart_type) in known_charts:
+				continue
+
+			with self.phase('charts'):
+				added = self.add_chart(
+					genres[chart.genre],
+					store,
+					chart_type,
+					timestamp,
+					chart.app_ids,
+				)
+			self.count('chart_entries', len(chart.app_ids))
+			self.success(f"Successfully added chart: {added}")
+
+	def store_entry(self, entry: CacheEntry, resource: Resource) -> datetime:
+		"""
+		Store a resource along with the cache entry it was read from and return
+		the time at which it has been committed.
+		"""
+
+		with self.phase('store'):
+			self.partitions.ensure(entry.timestamp)
+			with transaction.atomic():
+				self.store_resource(resource, entry.timestamp)
+				ScannedResponse.objects.get_or_create(
+					entry_id=entry.entry_id,
+					request_key=entry.source,
+					timestamp=entry.timestamp,
+				)
+				results.invalidate()
+		self.count('responses')
+		return timezone.now()
 
 	def add_arguments(self, parser: CommandParser):
 		parser.add_argument(
@@ -298,37 +427,217 @@ class Command(CoreCommand):
 			action='store_true',
 			help="Automatically update results.",
 		)
+		parser.add_argument(
+			'--full',
+			action='store_true',
+			help="""
+				Process all cached responses, including those that have already
+				been ingested by a previous scan. By default, only new or
+				changed responses are processed.
+			""",
+		)
+		parser.add_argument(
+			'-j', '--jobs',
+			type=int,
+			default=1,
+			help="""
+				Number of processes used for reading and decoding cached
+				responses. The results are written to the database by a single
+				process in the same order as if the responses were processed
+				serially. (default: 1)
+			""",
+		)
+		parser.add_argument(
+			'snapshots',
+			nargs='*',
+			metavar='snapshot',
+			help="""
+				Copies of the MAS cache to scan instead of the cache of the
+				current user, which is only available on macOS. A snapshot is
+				either a Cache.db file next to its fsCachedData directory, a
+				directory containing both, or a tar or zip archive of such a
+				directory.
+			""",
+		)
+		parser.add_argument(
+			'-w', '--watch',
+			action='store_true',
+			help="""
+				Keep running and ingest new or changed responses as soon as the
+				MAS writes them to its cache. The latency between writing to the
+				cache and committing to the database is reported. A single cache
+				directory can be given to watch instead of the cache of the
+				current user.
+			""",
+		)
+		parser.add_argument(
+			'--interval',
+			type=float,
+			default=1.0,
+			help="""
+				Seconds between checks for changes of the cache when watching it.
+				(default: 1.0)
+			""",
+		)
 
-	def handle(self, *args, **options):
-		if sys.platform != 'darwin':
-			raise CommandError("This command only works on macOS.")
+	def scan(
+		self,
+		cache: Cache,
+		full: bool = False,
+		jobs: int = 1,
+	) -> List[Tuple[CacheEntry, datetime]]:
+		"""
+		Scan the cache and return the stored entries along with the time at
+		which they have been committed.
+		"""
+
+		stored: List[Tuple[CacheEntry, datetime]] = []
+
+		# Partitions might have been changed since the last scan.
+		self.partitions = Partitions()
+
+		with self.phase('entries'):
+			entries = cache.entries()
+
+			if not full:
+				scanned = set(ScannedResponse.objects.filter(
+					entry_id__in={entry.entry_id for entry in entries},
+				).values_list('entry_id', 'request_key', 'timestamp'))
+				entries = [entry for entry in entries if entry not in scanned]
+
+		if jobs == 1:
+			for entry in entries:
+				with self.phase('read'):
+					cached = cache.read(entry.entry_id)
+				if cached is None:
+					continue
+				document, warnings = cached
+				with document:
+					self.count('bytes', len(document.buffer))
+					with self.phase('parse'):
+						resource = parse_resource(document, entry.source, warnings)
+					stored.append((entry, self.store_entry(entry, resource)))
+			return stored
+
+		from multiprocessing import Pool
+
+		# Worker processes do not use the database, so do not share the
+		# connection with them.
+		connections.close_all()
+
+		with Pool(jobs, initializer=init_worker, initargs=(cache.path, cache.read_only)) as pool:
+			# Results are returned in order, so the outcome is the same as
+			# when processing the entries serially.
+			resources = pool.imap(load_resource, entries)
+			for entry in entries:
+				# Reading and parsing happen in the workers, so this is the time
+				# spent waiting for them.
+				with self.phase('read'):
+					resource = next(resources)
+				if resource is None:
+					continue
+				stored.append((entry, self.store_entry(entry, resource)))
+
+		return stored
+
+	def watch(self, cache: Cache, interval: float, jobs: int = 1):
+		"""
+		Continuously scan the cache for new or changed responses. The cache is
+		only scanned if another connection committed changes to it since the
+		last poll. If the MAS replaces the `Cache.db`, it is reopened.
+		"""
+
+		identity: Optional[Tuple[int, int]] = None
+		version: Optional[int] = None
+
+		# Responses found by the first scan have been cached before watching
+		# started, so their latency is meaningless.
+		initial = True
+
+		while True:
+			try:
+				current_identity = cache.identity()
+			except FileNotFoundError:
+				cache.close()
+				identity = None
+				time.sleep(interval)
+				continue
+
+			if current_identity != identity:
+				cache.close()
+				identity = current_identity
+				version = None
+
+			current_version = cache.data_version()
+			if current_version != version:
+				version = current_version
+
+				# The database connection might have been idle for a long time.
+				close_old_connections()
+
+				stored = self.scan(cache, jobs=jobs)
+				if initial:
+					self.echo(f"Ingested {len(stored)} previously cached responses")
+					initial = False
+				elif stored:
+					latencies = [
+						(committed - entry.timestamp).total_seconds()
+						for entry, committed in stored
+					]
+					self.echo(
+						f"Ingested {len(stored)} responses, latency from cache "
+						f"write to commit: mean {sum(latencies) / len(latencies):.1f}s, "
+						f"max {max(latencies):.1f}s"
+					)
 
-		self.auto_update = options['auto_update']
+			time.sleep(interval)
 
-		c = self.cache_db.cursor()
-
-		rows = c.execute('''
-			SELECT
-				cfurl_cache_response.request_key,
-				cfurl_cache_response.time_stamp,
-				cfurl_cache_receiver_data.receiver_data,
-				cfurl_cache_receiver_data.isDataOnFS
-			FROM
-				cfurl_cache_response, cfurl_cache_receiver_data
-			WHERE
-				cfurl_cache_response.entry_ID == cfurl_cache_receiver_data.entry_ID
-				AND cfurl_cache_response.request_key LIKE 'https://api.apps.apple.com/v1/%';
-		''')
-
-		for row in rows.fetchall():
-			source: str = row[0]
-			timestamp = datetime.fromisoformat(row[1])
-			receiver_data: Union[bytes, str] = row[2]
-			should_be_on_fs = bool(row[3])
-
-			if not timezone.is_aware(timestamp):
-				timestamp = timezone.make_aware(timestamp, timezone=timezone.utc)
-
-			resource = self.get_cached_resource(receiver_data, should_be_on_fs)
-
-			self.process_resource(resource, source, timestamp)
+	def handle(self, *args, **options):
+		self.auto_update = options['auto_update']
+		full: bool = options['full']
+		jobs: int = options['jobs']
+		snapshots: List[str] = options['snapshots']
+		watch: bool = options['watch']
+		interval: float = options['interval']
+
+		if jobs < 1:
+			raise CommandError("The number of jobs needs to be positive.")
+		if interval <= 0:
+			raise CommandError("The interval needs to be positive.")
+
+		if watch:
+			if full:
+				raise CommandError("Watching the cache always scans incrementally.")
+			if 1 < len(snapshots):
+				raise CommandError("Only a single cache can be watched.")
+			if snapshots:
+				try:
+					cache = Cache(find_cache_dir(snapshots[0]))
+				except OSError as e:
+					raise CommandError(f"Failed to open cache: {e}")
+			else:
+				if sys.platform != 'darwin':
+					raise CommandError("This command only works on macOS.")
+				cache = self.cache
+			try:
+				self.watch(cache, interval, jobs=jobs)
+			except KeyboardInterrupt:
+				pass
+			return
+
+		if not snapshots:
+			if sys.platform != 'darwin':
+				raise CommandError("This command only works on macOS.")
+			self.scan(self.cache, full=full, jobs=jobs)
+			return
+
+		for snapshot in snapshots:
+			with ExitStack() as stack:
+				try:
+					cache = stack.enter_context(open_snapshot(snapshot))
+				except (OSError, ValueError) as e:
+					raise CommandError(f"Failed to open snapshot: {e}")
+				try:
+					self.scan(cache, full=full, jobs=jobs)
+				except sqlite3.DatabaseError as e:
+					raise CommandError(f"Failed to read snapshot {snapshot}: {e}")
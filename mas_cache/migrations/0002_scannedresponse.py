@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0001_initial'),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name='ScannedResponse',
+			fields=[
+				('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+				('entry_id', models.PositiveIntegerField()),
+				('request_key', models.URLField(max_length=4096)),
+				('timestamp', models.DateTimeField()),
+			],
+			options={
+				'unique_together': {('entry_id', 'request_key', 'timestamp')},
+			},
+		),
+	]
@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BATCH_SIZE = 1000
+
+
+def content_digest(data):
+	# Frozen copy of `mas_cache.models.content_digest` at the time of this
+	# migration, so that later changes do not affect it.
+	canonical = json.dumps(
+		data,
+		sort_keys=True,
+		separators=(',', ':'),
+		ensure_ascii=False,
+	)
+	return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def move_data_to_blobs(apps, schema_editor):
+	Metadata = apps.get_model('mas_cache', 'Metadata')
+	MetadataBlob = apps.get_model('mas_cache', 'MetadataBlob')
+	db_alias = schema_editor.connection.alias
+
+	def flush(metadatas):
+		blobs = {}
+		for metadata in metadatas:
+			digest = content_digest(metadata.data)
+			blobs[digest] = MetadataBlob(digest=digest, data=metadata.data)
+			metadata.blob_id = digest
+		MetadataBlob.objects.using(db_alias).bulk_create(blobs.values(), ignore_conflicts=True)
+		Metadata.objects.using(db_alias).bulk_update(metadatas, ['blob'])
+
+	metadatas = []
+	for metadata in Metadata.objects.using(db_alias).only('id', 'data').iterator(chunk_size=BATCH_SIZE):
+		metadatas.append(metadata)
+		if len(metadatas) == BATCH_SIZE:
+			flush(metadatas)
+			metadatas = []
+	if metadatas:
+		flush(metadatas)
+
+
+def move_blobs_to_data(apps, schema_editor):
+	Metadata = apps.get_model('mas_cache', 'Metadata')
+	db_alias = schema_editor.connection.alias
+
+	metadatas = []
+	for metadata in Metadata.objects.using(db_alias).select_related('blob').iterator(chunk_size=BATCH_SIZE):
+		metadata.data = metadata.blob.data
+		metadatas.append(metadata)
+		if len(metadatas) == BATCH_SIZE:
+			Metadata.objects.using(db_alias).bulk_update(metadatas, ['data'])
+			metadatas = []
+	if metadatas:
+		Metadata.objects.using(db_alias).bulk_update(metadatas, ['data'])
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0002_scannedresponse'),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name='MetadataBlob',
+			fields=[
+				('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+				('data', django.contrib.postgres.fields.jsonb.JSONField()),
+			],
+		),
+		migrations.AddField(
+			model_name='metadata',
+			name='blob',
+			field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='metadata', to='mas_cache.MetadataBlob'),
+		),
+		migrations.AlterField(
+			model_name='metadata',
+			name='data',
+			field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+		),
+		migrations.RunPython(move_data_to_blobs, move_blobs_to_data),
+	]
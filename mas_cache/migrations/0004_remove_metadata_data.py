@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0003_metadatablob'),
+	]
+
+	operations = [
+		migrations.RemoveField(
+			model_name='metadata',
+			name='data',
+		),
+		migrations.AlterField(
+			model_name='metadata',
+			name='blob',
+			field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='metadata', to='mas_cache.MetadataBlob'),
+		),
+	]
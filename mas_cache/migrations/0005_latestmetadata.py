@@ -0,0 +1,71 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BATCH_SIZE = 1000
+
+
+def populate_latest_metadata(apps, schema_editor):
+	Metadata = apps.get_model('mas_cache', 'Metadata')
+	LatestMetadata = apps.get_model('mas_cache', 'LatestMetadata')
+
+	metadatas = Metadata.objects.select_related('blob').order_by(
+		'application',
+		'store',
+		'-timestamp',
+		'-id',
+	)
+
+	latest = []
+	previous = None
+	for metadata in metadatas.iterator(chunk_size=BATCH_SIZE):
+		key = (metadata.application_id, metadata.store_id)
+		if key == previous:
+			continue
+		previous = key
+
+		data = metadata.blob.data
+		attributes = data.get('attributes', {})
+		platform_attributes = attributes.get('platformAttributes', {}).get('osx', {})
+		latest.append(LatestMetadata(
+			application_id=metadata.application_id,
+			store_id=metadata.store_id,
+			metadata=metadata,
+			timestamp=metadata.timestamp,
+			name=attributes.get('name', None),
+			bundle_identifier=platform_attributes.get('bundleId', None),
+			app_type=data.get('type', None),
+			is_known='attributes' in data,
+		))
+		if len(latest) == BATCH_SIZE:
+			LatestMetadata.objects.bulk_create(latest)
+			latest = []
+	LatestMetadata.objects.bulk_create(latest)
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0004_remove_metadata_data'),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name='LatestMetadata',
+			fields=[
+				('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+				('timestamp', models.DateTimeField()),
+				('name', models.TextField(blank=True, default=None, null=True)),
+				('bundle_identifier', models.TextField(blank=True, default=None, null=True)),
+				('app_type', models.CharField(blank=True, default=None, max_length=64, null=True)),
+				('is_known', models.BooleanField(default=False)),
+				('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='latest_by_store', to='mas_cache.Application')),
+				('metadata', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mas_cache.Metadata')),
+				('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mas_cache.AppStore')),
+			],
+			options={
+				'unique_together': {('application', 'store')},
+			},
+		),
+		migrations.RunPython(populate_latest_metadata, migrations.RunPython.noop),
+	]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0005_latestmetadata'),
+	]
+
+	operations = [
+		migrations.AlterField(
+			model_name='latestmetadata',
+			name='bundle_identifier',
+			field=models.TextField(blank=True, db_index=True, default=None, null=True),
+		),
+		migrations.AlterField(
+			model_name='latestmetadata',
+			name='name',
+			field=models.TextField(blank=True, db_index=True, default=None, null=True),
+		),
+	]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0006_latestmetadata_indexes'),
+	]
+
+	operations = [
+		migrations.AddIndex(
+			model_name='chartentry',
+			index=models.Index(fields=['application', 'chart'], name='chartentry_application_chart'),
+		),
+	]
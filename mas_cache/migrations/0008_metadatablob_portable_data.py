@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0007_chartentry_application_chart'),
+	]
+
+	operations = [
+		# Both fields use jsonb on PostgreSQL, so the schema does not change.
+		migrations.AlterField(
+			model_name='metadatablob',
+			name='data',
+			field=models.JSONField(),
+		),
+	]
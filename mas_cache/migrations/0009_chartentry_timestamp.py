@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_chart_timestamps(apps, schema_editor):
+	Chart = apps.get_model('mas_cache', 'Chart')
+	ChartEntry = apps.get_model('mas_cache', 'ChartEntry')
+	ChartEntry.objects.using(schema_editor.connection.alias).update(
+		timestamp=Subquery(Chart.objects.filter(pk=OuterRef('chart')).values('timestamp')[:1]),
+	)
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0008_metadatablob_portable_data'),
+	]
+
+	operations = [
+		migrations.AddField(
+			model_name='chartentry',
+			name='timestamp',
+			field=models.DateTimeField(null=True),
+		),
+		migrations.RunPython(copy_chart_timestamps, migrations.RunPython.noop),
+		migrations.AlterField(
+			model_name='chartentry',
+			name='timestamp',
+			field=models.DateTimeField(),
+		),
+	]
@@ -0,0 +1,43 @@
+import struct
+
+from itertools import groupby
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def pack_chart_entries(apps, schema_editor):
+	Chart = apps.get_model('mas_cache', 'Chart')
+	ChartEntry = apps.get_model('mas_cache', 'ChartEntry')
+	db_alias = schema_editor.connection.alias
+
+	pks = list(Chart.objects.using(db_alias).order_by('pk').values_list('pk', flat=True))
+	for start in range(0, len(pks), BATCH_SIZE):
+		batch = pks[start:start + BATCH_SIZE]
+		entries = ChartEntry.objects.using(db_alias).filter(
+			chart__in=batch,
+		).order_by('chart', 'position').values_list('chart', 'application')
+		charts = []
+		for chart, rows in groupby(entries, key=lambda row: row[0]):
+			app_ids = [app_id for _, app_id in rows]
+			charts.append(Chart(pk=chart, packed_app_ids=struct.pack(f'<{len(app_ids)}I', *app_ids)))
+		Chart.objects.using(db_alias).bulk_update(charts, ['packed_app_ids'])
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0009_chartentry_timestamp'),
+	]
+
+	operations = [
+		migrations.AddField(
+			model_name='chart',
+			name='packed_app_ids',
+			field=models.BinaryField(default=b'', editable=False),
+			preserve_default=False,
+		),
+		migrations.RunPython(pack_chart_entries, migrations.RunPython.noop),
+	]
@@ -0,0 +1,26 @@
+import uuid
+
+from django.db import migrations, models
+
+
+def create_data_version(apps, schema_editor):
+	DataVersion = apps.get_model('mas_cache', 'DataVersion')
+	DataVersion.objects.using(schema_editor.connection.alias).create(pk=1, token=uuid.uuid4().hex)
+
+
+class Migration(migrations.Migration):
+
+	dependencies = [
+		('mas_cache', '0010_chart_packed_app_ids'),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name='DataVersion',
+			fields=[
+				('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+				('token', models.CharField(max_length=32)),
+			],
+		),
+		migrations.RunPython(create_data_version, migrations.RunPython.noop),
+	]
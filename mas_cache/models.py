@@ -1,8 +1,14 @@
-from typing import Any, Dict, Optional
+import hashlib
+import json
+import struct
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
-from django.contrib.postgres.fields import JSONField
 from django.core.validators import RegexValidator
-from django.db import models
+from django.db import connections, models
+from django.db.models import Expression, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.utils.timezone import datetime
 from django.utils.translation import gettext_lazy as _
 
@@ -16,6 +22,39 @@ def CountryCodeValidator() -> RegexValidator:
 	return RegexValidator(r'^[a-z]{2}$')
 
 
+# Content Addressing
+
+
+def content_digest(data: Any) -> str:
+	"""
+	Return the SHA-256 digest of the canonical JSON representation of `data`.
+	"""
+
+	canonical = json.dumps(
+		data,
+		sort_keys=True,
+		separators=(',', ':'),
+		ensure_ascii=False,
+	)
+	return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# Packed Charts
+
+
+def pack_app_ids(app_ids: Sequence[int]) -> bytes:
+	"""
+	Pack application IDs as unsigned 32-bit integers in little-endian byte
+	order, which takes 4 bytes per chart position.
+	"""
+
+	return struct.pack(f'<{len(app_ids)}I', *app_ids)
+
+
+def unpack_app_ids(data: bytes) -> List[int]:
+	return list(struct.unpack(f'<{len(data) // 4}I', data))
+
+
 # Enums
 
 
@@ -36,42 +75,195 @@ class ChartType(models.IntegerChoices):
 		return CHART_TYPE_API[int(self)]
 
 
+# Query Sets
+
+
+def latest_metadata_annotations(application: str) -> Dict[str, Expression]:
+	"""
+	Return annotations for the fields of the latest metadata of the
+	application referenced by the field `application` of the outer query, as
+	maintained by `LatestMetadata`. Bundles and known applications can be
+	filtered by `latest_app_type` and `latest_is_known`, which are never null.
+	"""
+
+	latest = LatestMetadata.objects.filter(
+		application=OuterRef(application),
+	).order_by('-timestamp', '-metadata')
+
+	def field(name: str) -> Subquery:
+		return Subquery(latest.values(name)[:1])
+
+	return {
+		'latest_timestamp': field('timestamp'),
+		'latest_name': field('name'),
+		'latest_bundle_identifier': field('bundle_identifier'),
+		'latest_app_type': Coalesce(field('app_type'), Value('')),
+		'latest_is_known': Coalesce(field('is_known'), Value(False)),
+	}
+
+
+def prefix_range(field: str, prefix: str) -> Dict[str, Any]:
+	"""
+	Return lookups for the values of `field` starting with `prefix` as a range,
+	which matches case-sensitively and uses an index on SQLite, where values
+	are compared by their code points. In contrast, `startswith` becomes a
+	case-insensitive `LIKE` there, which cannot use an index.
+	"""
+
+	# Code points that cannot be incremented are removed, which widens the
+	# range, but strings of the range still start with the remaining prefix.
+	stem = prefix.rstrip(chr(0x10FFFF))
+	if not stem:
+		return {f'{field}__gte': prefix}
+	following = ord(stem[-1]) + 1
+	if 0xD800 <= following <= 0xDFFF:
+		# Surrogates cannot be encoded.
+		following = 0xE000
+	return {
+		f'{field}__gte': prefix,
+		f'{field}__lt': stem[:-1] + chr(following),
+	}
+
+
+class ApplicationQuerySet(models.QuerySet):
+
+	def with_latest(self) -> 'ApplicationQuerySet':
+		return self.annotate(**latest_metadata_annotations('pk'))
+
+	def _latest_matching(
+		self,
+		store: Optional['AppStore'],
+		**lookups,
+	) -> 'ApplicationQuerySet':
+		latest = LatestMetadata.objects.filter(**lookups)
+		if store is not None:
+			latest = latest.filter(store=store)
+		return self.filter(pk__in=latest.values('application'))
+
+	def with_name(
+		self,
+		name: str,
+		prefix: bool = False,
+		store: Optional['AppStore'] = None,
+	) -> 'ApplicationQuerySet':
+		"""
+		Filter applications by the name in their latest metadata, or by its
+		prefix. Both lookups are case-sensitive and use an index.
+		"""
+
+		if prefix:
+			if connections[self.db].vendor == 'sqlite':
+				return self._latest_matching(store, **prefix_range('name', name))
+			return self._latest_matching(store, name__startswith=name)
+		return self._latest_matching(store, name=name)
+
+	def with_bundle_identifier(
+		self,
+		bundle_identifier: str,
+		store: Optional['AppStore'] = None,
+	) -> 'ApplicationQuerySet':
+		"""
+		Filter applications by the bundle identifier in their latest metadata,
+		using an index.
+		"""
+
+		return self._latest_matching(store, bundle_identifier=bundle_identifier)
+
+
+class ChartEntryQuerySet(models.QuerySet):
+
+	def with_latest(
+		self,
+		skip_bundles: bool = False,
+		skip_unknown: bool = False,
+	) -> 'ChartEntryQuerySet':
+		"""
+		Annotate entries with the latest metadata of their applications, see
+		`latest_metadata_annotations`, and optionally exclude bundles and
+		applications without metadata.
+		"""
+
+		entries = self.annotate(**latest_metadata_annotations('application'))
+		if skip_bundles:
+			entries = entries.exclude(latest_app_type='app-bundles')
+		if skip_unknown:
+			entries = entries.filter(latest_is_known=True)
+		return entries
+
+
 # Models
 
 
 class Application(models.Model):
 	itunes_id = models.PositiveIntegerField(primary_key=True)
 
+	objects = ApplicationQuerySet.as_manager()
+
+	@cached_property
+	def latest(self) -> Optional['LatestMetadata']:
+		return self.latest_by_store.order_by('-timestamp', '-metadata').first()
+
 	@property
 	def latest_metadata(self) -> Optional['Metadata']:
-		metadata = Metadata.objects.filter(
-			application=self,
-			data__isnull=False,
-		).order_by('-timestamp')
-		if not metadata.exists():
+		latest = self.latest
+		if latest is None:
 			return None
-		return metadata.first()
+		return Metadata.objects.select_related('blob').get(
+			pk=latest.metadata_id,
+			timestamp=latest.timestamp,
+		)
+
+	def latest_known_metadata(self, store: 'AppStore') -> Optional['Metadata']:
+		"""
+		Return the latest metadata in the given store that contains actual
+		data. Sometimes applications are fetched lazily by the MAS, meaning
+		that there is only a placeholder without attributes.
+		"""
+
+		metadatas = Metadata.objects.filter(
+			application=self,
+			store=store,
+		).select_related('blob').order_by('-timestamp')
+
+		# Usually, the latest snapshot has attributes. It is looked up along
+		# with its timestamp, so that only a single partition is scanned.
+		latest = LatestMetadata.objects.filter(
+			application=self,
+			store=store,
+			is_known=True,
+		)
+		metadata = metadatas.filter(
+			pk=Subquery(latest.values('metadata')),
+			timestamp=Subquery(latest.values('timestamp')),
+		).first()
+		if metadata is not None:
+			return metadata
+
+		for metadata in metadatas:
+			if 'attributes' in metadata.data:
+				return metadata
+		return None
 
 	@property
 	def is_known(self) -> bool:
-		metadata = self.latest_metadata
-		if metadata is None:
+		latest = self.latest
+		if latest is None:
 			return False
-		return 'attributes' in metadata.data
+		return latest.is_known
 
 	@property
 	def is_bundle(self) -> bool:
-		metadata = self.latest_metadata
-		if metadata is None:
+		latest = self.latest
+		if latest is None:
 			return False
-		return metadata.data.get('type', None) == 'app-bundles'
+		return latest.app_type == 'app-bundles'
 
 	@property
 	def timestamp(self) -> Optional[datetime]:
-		metadata = self.latest_metadata
-		if metadata is None:
+		latest = self.latest
+		if latest is None:
 			return None
-		return metadata.timestamp
+		return latest.timestamp
 
 	@property
 	def attributes(self) -> Dict[str, Any]:
@@ -85,11 +277,17 @@ class Application(models.Model):
 
 	@property
 	def name(self) -> Optional[str]:
-		return self.attributes.get('name', None)
+		latest = self.latest
+		if latest is None:
+			return None
+		return latest.name
 
 	@property
 	def bundle_identifier(self) -> Optional[str]:
-		return self.platform_attributes().get('bundleId', None)
+		latest = self.latest
+		if latest is None:
+			return None
+		return latest.bundle_identifier
 
 	def __str__(self) -> str:
 		if self.name is None:
@@ -97,6 +295,10 @@ class Application(models.Model):
 		return self.name
 
 
+# The genre of the App Store itself, which is the parent of all other genres
+APP_STORE_GENRE = 36
+
+
 class Genre(models.Model):
 	itunes_id = models.PositiveSmallIntegerField(primary_key=True)
 	name = models.CharField(max_length=255, blank=True, null=True, default=None)
@@ -133,17 +335,157 @@ class AppStore(models.Model):
 		return f"{self.country}"
 
 
+class MetadataBlob(models.Model):
+	"""
+	Application metadata, stored once per distinct content. The same metadata
+	is usually cached for many sources and timestamps.
+	"""
+
+	digest = models.CharField(max_length=64, primary_key=True)
+	data = models.JSONField()
+
+	@classmethod
+	def from_data(cls, data: Dict[str, Any]) -> 'MetadataBlob':
+		return cls(digest=content_digest(data), data=data)
+
+
 class Metadata(models.Model):
 	application = models.ForeignKey(Application, on_delete=models.CASCADE)
 	store = models.ForeignKey(AppStore, on_delete=models.CASCADE)
 	source = models.URLField(max_length=4096)
 	timestamp = models.DateTimeField()
-	data = JSONField()
+	blob = models.ForeignKey(
+		MetadataBlob,
+		on_delete=models.PROTECT,
+		related_name='metadata',
+	)
+
+	@property
+	def digest(self) -> str:
+		"""
+		The canonical content digest, see `content_digest`. Available without
+		loading the content.
+		"""
+
+		return self.blob_id
+
+	@property
+	def data(self) -> Dict[str, Any]:
+		return self.blob.data
 
 	class Meta:
 		unique_together = (('application', 'store', 'source', 'timestamp'),)
 
 
+class LatestMetadataManager(models.Manager):
+
+	def track(self, metadatas: Iterable[Metadata]):
+		"""
+		Update the projection with the given snapshots, which need to be saved
+		already and have their content loaded. Snapshots that are older than the
+		tracked ones are ignored.
+		"""
+
+		candidates: Dict[Tuple[int, str], Metadata] = {}
+		for metadata in metadatas:
+			key = (metadata.application_id, metadata.store_id)
+			candidate = candidates.get(key, None)
+			if candidate is None or LatestMetadata.is_newer(metadata, candidate.timestamp, candidate.pk):
+				candidates[key] = metadata
+
+		if not candidates:
+			return
+
+		existing = {
+			(latest.application_id, latest.store_id): latest
+			for latest in self.filter(
+				application__in={key[0] for key in candidates.keys()},
+				store__in={key[1] for key in candidates.keys()},
+			)
+		}
+
+		created: List[LatestMetadata] = []
+		updated: List[LatestMetadata] = []
+		for key, metadata in candidates.items():
+			latest = existing.get(key, None)
+			if latest is None:
+				latest = LatestMetadata(application_id=key[0], store_id=key[1])
+				latest.assign(metadata)
+				created.append(latest)
+			elif LatestMetadata.is_newer(metadata, latest.timestamp, latest.metadata_id):
+				latest.assign(metadata)
+				updated.append(latest)
+
+		self.bulk_create(created)
+		self.bulk_update(updated, LatestMetadata.PROJECTED_FIELDS)
+
+
+class LatestMetadata(models.Model):
+	"""
+	The latest snapshot of an application's metadata per store, along with the
+	fields that are commonly accessed. Maintained on ingest, so that reading the
+	latest state does not require searching and loading the snapshots.
+	"""
+
+	PROJECTED_FIELDS = [
+		'metadata',
+		'timestamp',
+		'name',
+		'bundle_identifier',
+		'app_type',
+		'is_known',
+	]
+
+	application = models.ForeignKey(
+		Application,
+		on_delete=models.CASCADE,
+		related_name='latest_by_store',
+	)
+	store = models.ForeignKey(
+		AppStore,
+		on_delete=models.CASCADE,
+		related_name='+',
+	)
+	metadata = models.ForeignKey(
+		Metadata,
+		on_delete=models.CASCADE,
+		related_name='+',
+	)
+	timestamp = models.DateTimeField()
+	name = models.TextField(blank=True, null=True, default=None, db_index=True)
+	bundle_identifier = models.TextField(
+		blank=True,
+		null=True,
+		default=None,
+		db_index=True,
+	)
+	app_type = models.CharField(max_length=64, blank=True, null=True, default=None)
+	is_known = models.BooleanField(default=False)
+
+	objects = LatestMetadataManager()
+
+	class Meta:
+		unique_together = (('application', 'store'),)
+
+	@staticmethod
+	def is_newer(metadata: Metadata, timestamp: datetime, metadata_id: int) -> bool:
+		# Snapshots of the same time are ordered by insertion, so that updated
+		# content for an existing snapshot is picked up as well.
+		return (metadata.timestamp, metadata.pk) >= (timestamp, metadata_id)
+
+	def assign(self, metadata: Metadata):
+		data = metadata.data
+		attributes = data.get('attributes', {})
+		platform_attributes = attributes.get('platformAttributes', {}).get('osx', {})
+
+		self.metadata = metadata
+		self.timestamp = metadata.timestamp
+		self.name = attributes.get('name', None)
+		self.bundle_identifier = platform_attributes.get('bundleId', None)
+		self.app_type = data.get('type', None)
+		self.is_known = 'attributes' in data
+
+
 class Chart(models.Model):
 	genre = models.ForeignKey(
 		Genre,
@@ -157,10 +499,17 @@ class Chart(models.Model):
 	)
 	chart_type = IntegerChoicesField(ChartType)
 	timestamp = models.DateTimeField()
+	# The applications in order of their position, see `pack_app_ids`. Charts
+	# are read from this column, the entries are derived from it.
+	packed_app_ids = models.BinaryField(editable=False)
 
 	class Meta:
 		unique_together = (('genre', 'store', 'chart_type', 'timestamp'),)
 
+	@property
+	def app_ids(self) -> List[int]:
+		return unpack_app_ids(self.packed_app_ids)
+
 
 class ChartEntry(models.Model):
 	chart = models.ForeignKey(
@@ -170,6 +519,10 @@ class ChartEntry(models.Model):
 	)
 	application = models.ForeignKey(Application, on_delete=models.CASCADE)
 	position = models.PositiveSmallIntegerField()
+	# The timestamp of the chart, by which entries can be partitioned
+	timestamp = models.DateTimeField()
+
+	objects = ChartEntryQuerySet.as_manager()
 
 	class Meta:
 		unique_together = (
@@ -177,3 +530,34 @@ class ChartEntry(models.Model):
 			('chart', 'position'),
 			('chart', 'application', 'position'),
 		)
+		indexes = (
+			# Partitions entries by application for chart histories
+			models.Index(
+				fields=['application', 'chart'],
+				name='chartentry_application_chart',
+			),
+		)
+
+
+class ScannedResponse(models.Model):
+	"""
+	A response of the MAS cache (`cfurl_cache_response`) that has already been
+	ingested. Used for skipping unchanged entries on subsequent scans.
+	"""
+
+	entry_id = models.PositiveIntegerField()
+	request_key = models.URLField(max_length=4096)
+	timestamp = models.DateTimeField()
+
+	class Meta:
+		unique_together = (('entry_id', 'request_key', 'timestamp'),)
+
+
+class DataVersion(models.Model):
+	"""
+	A single row with a token, which is replaced in every transaction that
+	changes the data, see `mas_cache.results`. Since the token is committed
+	along with the data, all processes see the new version at once.
+	"""
+
+	token = models.CharField(max_length=32)
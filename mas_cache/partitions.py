@@ -0,0 +1,340 @@
+"""
+Optional range partitioning of large tables by timestamp on PostgreSQL.
+
+`Metadata` and `ChartEntry` grow with every scan, while reading mostly touches
+the latest snapshots and charts. When partitioning is enabled, both tables are
+partitioned by month, so that queries that filter by timestamp only scan the
+partitions of the time range, and old partitions can be detached as archive
+tables or dropped.
+
+Since the partition key needs to be part of every primary key and unique
+constraint, the constraints of partitioned tables include the timestamp and
+foreign keys to them reference it as well. Django is not aware of this, which
+is why the projection of the latest metadata stores the timestamp of the
+snapshot along with its ID.
+
+There is no default partition, so rows need to be inserted into existing
+partitions. `Partitions.ensure` creates the partition of a timestamp if it is
+missing, and the `partitions` command creates partitions ahead of time.
+"""
+
+import re
+
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Type
+
+from django.db import connection, models, transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import datetime, utc
+
+from mas_cache.models import ChartEntry, LatestMetadata, Metadata
+
+
+# First day of a month
+Month = Tuple[int, int]
+
+
+class Reference(NamedTuple):
+	model: Type[models.Model]
+	field: str  # Foreign key to the partitioned table
+	key: str  # Field with the timestamp of the referenced row
+
+
+class PartitionedTable(NamedTuple):
+	model: Type[models.Model]
+	key: str  # Timestamp by which rows are partitioned
+	references: Tuple[Reference, ...] = ()
+
+	@property
+	def table(self) -> str:
+		return self.model._meta.db_table
+
+	def column(self, field: str, model: Optional[Type[models.Model]] = None) -> str:
+		return (model or self.model)._meta.get_field(field).column
+
+
+TABLES = (
+	PartitionedTable(Metadata, 'timestamp', (
+		Reference(LatestMetadata, 'metadata', 'timestamp'),
+	)),
+	PartitionedTable(ChartEntry, 'timestamp'),
+)
+
+
+class Partition(NamedTuple):
+	name: str
+	start: datetime
+	end: datetime
+	rows: int  # Estimated
+
+
+class PartitionError(Exception):
+	pass
+
+
+def is_supported() -> bool:
+	return connection.vendor == 'postgresql'
+
+
+def month_of(timestamp: datetime) -> Month:
+	timestamp = timestamp.astimezone(utc)
+	return timestamp.year, timestamp.month
+
+
+def next_month(month: Month) -> Month:
+	year, number = month
+	if number == 12:
+		return year + 1, 1
+	return year, number + 1
+
+
+def month_range(month: Month) -> Tuple[datetime, datetime]:
+	return (
+		datetime(*month, 1, tzinfo=utc),
+		datetime(*next_month(month), 1, tzinfo=utc),
+	)
+
+
+def partition_name(table: PartitionedTable, month: Month) -> str:
+	return f'{table.table}_{month[0]:04d}_{month[1]:02d}'
+
+
+def quote(name: str) -> str:
+	return connection.ops.quote_name(name)
+
+
+def partitioned_tables() -> Dict[str, Set[Month]]:
+	"""
+	Return the months of the partitions of each partitioned table. Tables that
+	are not partitioned are omitted.
+	"""
+
+	if not is_supported():
+		return {}
+
+	with connection.cursor() as cursor:
+		cursor.execute('''
+			SELECT parent.relname, partition.relname
+			FROM pg_partitioned_table
+			JOIN pg_class parent ON parent.oid = pg_partitioned_table.partrelid
+			LEFT JOIN pg_inherits ON pg_inherits.inhparent = parent.oid
+			LEFT JOIN pg_class partition ON partition.oid = pg_inherits.inhrelid
+			WHERE parent.relname = ANY(%s)
+		''', [[table.table for table in TABLES]])
+		rows = cursor.fetchall()
+
+	tables: Dict[str, Set[Month]] = {}
+	for parent, partition in rows:
+		months = tables.setdefault(parent, set())
+		match = re.fullmatch(rf'{re.escape(parent)}_(\d{{4}})_(\d{{2}})', partition or '')
+		if match is not None:
+			months.add((int(match[1]), int(match[2])))
+	return tables
+
+
+def partitions(table: PartitionedTable) -> List[Partition]:
+	"""
+	Return the partitions of a partitioned table ordered by their range.
+	"""
+
+	with connection.cursor() as cursor:
+		cursor.execute('''
+			SELECT
+				partition.relname,
+				pg_get_expr(partition.relpartbound, partition.oid),
+				partition.reltuples::bigint
+			FROM pg_inherits
+			JOIN pg_class partition ON partition.oid = pg_inherits.inhrelid
+			WHERE pg_inherits.inhparent = %s::regclass
+		''', [table.table])
+		rows = cursor.fetchall()
+
+	result: List[Partition] = []
+	for name, bound, rows_estimate in rows:
+		match = re.fullmatch(r"FOR VALUES FROM \('(.+)'\) TO \('(.+)'\)", bound)
+		if match is None:
+			raise PartitionError(f"Unexpected partition bound of {name}: {bound}")
+		start = parse_datetime(match[1])
+		end = parse_datetime(match[2])
+		assert start is not None and end is not None
+		result.append(Partition(name, start, end, max(rows_estimate, 0)))
+	return sorted(result, key=lambda partition: partition.start)
+
+
+def create_partition(table: PartitionedTable, month: Month):
+	start, end = month_range(month)
+	with connection.cursor() as cursor:
+		cursor.execute(
+			f'CREATE TABLE IF NOT EXISTS {quote(partition_name(table, month))} '
+			f'PARTITION OF {quote(table.table)} FOR VALUES FROM (%s) TO (%s)',
+			[start, end],
+		)
+
+
+@transaction.atomic
+def enable(table: PartitionedTable, months_ahead: int = 3):
+	"""
+	Convert a table into a table partitioned by month. The rows are copied into
+	partitions for all months with data as well as the current and following
+	months. Constraints and indexes are recreated with the same names, primary
+	keys and unique constraints include the partition key. Foreign keys to the
+	table are recreated, if they are known by `PartitionedTable.references`.
+	"""
+
+	name = table.table
+	key = table.column(table.key)
+	old = f'{name}_unpartitioned'
+
+	with connection.cursor() as cursor:
+		# Tables with pending checks of deferred constraints cannot be altered.
+		cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+		cursor.execute('''
+			SELECT conname, contype, pg_get_constraintdef(oid)
+			FROM pg_constraint
+			WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')
+			ORDER BY contype
+		''', [name])
+		constraints: List[Tuple[str, str, str]] = cursor.fetchall()
+
+		cursor.execute('''
+			SELECT index.relname, pg_get_indexdef(index.oid)
+			FROM pg_index
+			JOIN pg_class index ON index.oid = pg_index.indexrelid
+			WHERE pg_index.indrelid = %s::regclass AND NOT EXISTS (
+				SELECT FROM pg_constraint
+				WHERE conrelid = pg_index.indrelid AND conindid = pg_index.indexrelid
+			)
+		''', [name])
+		indexes: List[Tuple[str, str]] = cursor.fetchall()
+
+		known = {
+			(reference.model._meta.db_table, table.column(reference.field, reference.model)): reference
+			for reference in table.references
+		}
+		cursor.execute('''
+			SELECT conname, conrelid::regclass::text, attname
+			FROM pg_constraint
+			JOIN pg_attribute ON attrelid = conrelid AND attnum = conkey[1]
+			WHERE confrelid = %s::regclass AND contype = 'f'
+		''', [name])
+		incoming: List[Tuple[str, str, str]] = cursor.fetchall()
+		for constraint, referencing, column in incoming:
+			if (referencing, column) not in known:
+				raise PartitionError(f"Unknown foreign key {constraint} of {referencing} to {name}")
+
+		cursor.execute(
+			f'SELECT DISTINCT date_trunc(\'month\', {quote(key)} AT TIME ZONE \'UTC\') FROM {quote(name)}'
+		)
+		months = {(row[0].year, row[0].month) for row in cursor.fetchall()}
+
+		# Free the names of the constraints and indexes, which are recreated
+		# on the partitioned table.
+		for constraint, referencing, _ in incoming:
+			cursor.execute(f'ALTER TABLE {quote(referencing)} DROP CONSTRAINT {quote(constraint)}')
+		cursor.execute(f'ALTER TABLE {quote(name)} RENAME TO {quote(old)}')
+		for constraint, _, _ in reversed(constraints):
+			cursor.execute(f'ALTER TABLE {quote(old)} DROP CONSTRAINT {quote(constraint)}')
+		for index, _ in indexes:
+			cursor.execute(f'DROP INDEX {quote(index)}')
+
+		cursor.execute(
+			f'CREATE TABLE {quote(name)} (LIKE {quote(old)} INCLUDING DEFAULTS) '
+			f'PARTITION BY RANGE ({quote(key)})'
+		)
+		# Sequences of serial columns would be dropped along with the old table.
+		cursor.execute('''
+			SELECT attname, pg_get_serial_sequence(%s, attname)
+			FROM pg_attribute
+			WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+		''', [old, old])
+		for column, sequence in cursor.fetchall():
+			if sequence is not None:
+				cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(name)}.{quote(column)}')
+
+		current = month_of(datetime.now(utc))
+		for _ in range(months_ahead + 1):
+			months.add(current)
+			current = next_month(current)
+		for month in sorted(months):
+			create_partition(table, month)
+
+		cursor.execute(f'INSERT INTO {quote(name)} SELECT * FROM {quote(old)}')
+		cursor.execute(f'DROP TABLE {quote(old)}')
+
+		for constraint, constraint_type, definition in constraints:
+			if constraint_type in ('p', 'u'):
+				columns = re.fullmatch(r'(PRIMARY KEY|UNIQUE) \((.*)\)', definition)
+				if columns is None:
+					raise PartitionError(f"Unexpected constraint {constraint}: {definition}")
+				if key not in [column.strip().strip('"') for column in columns[2].split(',')]:
+					definition = f'{columns[1]} ({columns[2]}, {quote(key)})'
+			cursor.execute(f'ALTER TABLE {quote(name)} ADD CONSTRAINT {quote(constraint)} {definition}')
+		for _, definition in indexes:
+			cursor.execute(definition)
+
+		for constraint, referencing, column in incoming:
+			reference = known[(referencing, column)]
+			cursor.execute(
+				f'ALTER TABLE {quote(referencing)} ADD CONSTRAINT {quote(constraint)} '
+				f'FOREIGN KEY ({quote(column)}, {quote(table.column(reference.key, reference.model))}) '
+				f'REFERENCES {quote(name)} ({quote(table.model._meta.pk.column)}, {quote(key)}) '
+				f'DEFERRABLE INITIALLY DEFERRED'
+			)
+
+
+@transaction.atomic
+def detach(table: PartitionedTable, partition: Partition, drop: bool = False):
+	"""
+	Detach a partition from its table. The partition is kept as a standalone
+	archive table without foreign keys, unless it is dropped.
+	"""
+
+	for reference in table.references:
+		referenced = reference.model.objects.filter(**{
+			f'{reference.key}__gte': partition.start,
+			f'{reference.key}__lt': partition.end,
+		}).count()
+		if referenced:
+			raise PartitionError(
+				f"Partition {partition.name} is still referenced by {referenced} "
+				f"rows of {reference.model._meta.db_table}"
+			)
+
+	with connection.cursor() as cursor:
+		cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+		cursor.execute(f'ALTER TABLE {quote(table.table)} DETACH PARTITION {quote(partition.name)}')
+		if drop:
+			cursor.execute(f'DROP TABLE {quote(partition.name)}')
+			return
+
+		cursor.execute('''
+			SELECT conname
+			FROM pg_constraint
+			WHERE conrelid = %s::regclass AND contype = 'f'
+		''', [partition.name])
+		for constraint, in cursor.fetchall():
+			cursor.execute(f'ALTER TABLE {quote(partition.name)} DROP CONSTRAINT {quote(constraint)}')
+
+
+class Partitions:
+	"""
+	Creates missing partitions for timestamps before rows are inserted. The
+	partitioned tables and their partitions are looked up once.
+	"""
+
+	def __init__(self):
+		self.tables: Optional[Dict[str, Set[Month]]] = None
+
+	def ensure(self, timestamp: datetime):
+		if self.tables is None:
+			self.tables = partitioned_tables()
+		if not self.tables:
+			return
+
+		month = month_of(timestamp)
+		for table in TABLES:
+			months = self.tables.get(table.table, None)
+			if months is None or month in months:
+				continue
+			create_partition(table, month)
+			months.add(month)
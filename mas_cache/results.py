@@ -0,0 +1,283 @@
+"""
+Caching of query results, which are expensive to compute but only change when
+new data is committed, e. g., by `scan`.
+
+Results are stored in the default cache of Django's cache framework along
+with the data version they were computed for. The data version is a random
+token in the database, see `DataVersion`, which is replaced by `invalidate` in
+every transaction that changes the data, so that all results become stale at
+once in all processes. To avoid a query per result, a process reuses the token
+it read for `VERSION_TTL` seconds, so new data is visible after at most that
+long. Results are only shared between processes if the cache backend is, e. g.,
+a file-based cache, otherwise each process caches its own results.
+"""
+
+import time
+import uuid
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple, TypeVar
+
+from django.core.cache import cache
+from django.utils.timezone import datetime
+
+from mas_cache.models import (
+	APP_STORE_GENRE,
+	Application,
+	AppStore,
+	Chart,
+	ChartType,
+	DataVersion,
+	Genre,
+	unpack_app_ids,
+)
+
+
+T = TypeVar('T')
+
+VERSION_TTL = 1.0
+
+# The data version read last and when it expires (monotonic clock)
+_version: Optional[Tuple[str, float]] = None
+
+
+def result_key(name: str, *parts: Hashable) -> str:
+	return ':'.join(('mas_cache', name) + tuple(str(part) for part in parts))
+
+
+def data_version() -> str:
+	"""
+	Return the current data version, which changes whenever data is committed.
+	"""
+
+	global _version
+	if _version is not None and time.monotonic() < _version[1]:
+		return _version[0]
+
+	version = DataVersion.objects.filter(pk=1).values_list('token', flat=True).first() or ''
+	_version = (version, time.monotonic() + VERSION_TTL)
+	return version
+
+
+def invalidate():
+	"""
+	Mark all cached results as stale. Needs to be called in the transaction
+	that changes the data, so that the new version is committed along with it.
+	"""
+
+	global _version
+	token = uuid.uuid4().hex
+	if not DataVersion.objects.filter(pk=1).update(token=token):
+		DataVersion.objects.create(pk=1, token=token)
+	_version = None
+
+
+def cached(key: str, compute: Callable[[], T]) -> T:
+	"""
+	Return the cached result for `key`, or compute and cache it if there is no
+	result for the current data version. Exceptions raised by `compute` are
+	propagated and nothing is cached.
+	"""
+
+	version = data_version()
+	entry: Any = cache.get(key)
+	if entry is not None:
+		entry_version, result = entry
+		if entry_version == version:
+			return result
+
+	# If the data changes while computing, the result is stored for the
+	# previous version and will not be returned.
+	result = compute()
+	cache.set(key, (version, result), None)
+	return result
+
+
+# Cached Queries
+
+
+def default_store() -> Optional[AppStore]:
+	"""
+	Return the store used if none is given, i. e., the first one.
+	"""
+
+	return cached(result_key('default-store'), lambda: AppStore.objects.first())
+
+
+def default_genre() -> Optional[Genre]:
+	"""
+	Return the genre used if none is given, i. e., the App Store itself.
+	"""
+
+	return cached(
+		result_key('default-genre'),
+		lambda: Genre.objects.filter(itunes_id=APP_STORE_GENRE).first(),
+	)
+
+
+def latest_applications(
+	app_ids: Iterable[int],
+	skip_bundles: bool = False,
+	skip_unknown: bool = False,
+) -> Dict[int, Tuple[Optional[str], Optional[str]]]:
+	"""
+	Return the latest bundle identifiers and names of applications with a
+	single query, optionally without bundles and applications without
+	metadata.
+	"""
+
+	apps = Application.objects.filter(pk__in=list(app_ids)).with_latest()
+	if skip_bundles:
+		apps = apps.exclude(latest_app_type='app-bundles')
+	if skip_unknown:
+		apps = apps.filter(latest_is_known=True)
+	return {
+		app_id: (bundle_identifier, name)
+		for app_id, bundle_identifier, name in apps.values_list(
+			'pk',
+			'latest_bundle_identifier',
+			'latest_name',
+		)
+	}
+
+
+class ChartRow(NamedTuple):
+	position: int  # Starting at 0
+	app_id: int
+	bundle_identifier: Optional[str]
+	name: Optional[str]
+
+
+class LatestChart(NamedTuple):
+	chart_id: int
+	timestamp: datetime
+	rows: List[ChartRow]
+
+
+def latest_chart(
+	store: AppStore,
+	genre: Genre,
+	chart_type: ChartType,
+	skip_bundles: bool = False,
+	skip_unknown: bool = False,
+	at: Optional[datetime] = None,
+) -> Optional[LatestChart]:
+	"""
+	Return the entries of the latest chart (at the given point in time) along
+	with the latest names and bundle identifiers of their applications.
+	"""
+
+	def load() -> Optional[LatestChart]:
+		charts = Chart.objects.filter(
+			genre=genre,
+			store=store,
+			chart_type=chart_type,
+		)
+		if at is not None:
+			charts = charts.filter(timestamp__lte=at)
+		chart = charts.order_by('-timestamp').first()
+		if chart is None:
+			return None
+
+		app_ids = chart.app_ids
+		apps = latest_applications(app_ids, skip_bundles, skip_unknown)
+		rows = [
+			ChartRow(position, app_id, *apps[app_id])
+			for position, app_id in enumerate(app_ids)
+			if app_id in apps
+		]
+		return LatestChart(chart.pk, chart.timestamp, rows)
+
+	return cached(result_key(
+		'chart',
+		store.pk,
+		genre.pk,
+		int(chart_type),
+		skip_bundles,
+		skip_unknown,
+		at.isoformat() if at is not None else None,
+	), load)
+
+
+class HistoryRow(NamedTuple):
+	timestamp: datetime
+	position: int  # Starting at 0
+	app_id: int
+	bundle_identifier: Optional[str]
+	name: Optional[str]
+	movement: Optional[int]  # Positive if the application moved up
+	entered: bool  # Not part of the previous chart
+	exited: bool  # Not part of the next chart
+
+
+def chart_history(
+	store: AppStore,
+	genre: Genre,
+	chart_type: ChartType,
+	skip_bundles: bool = False,
+	skip_unknown: bool = False,
+	since: Optional[datetime] = None,
+	until: Optional[datetime] = None,
+	names: bool = True,
+) -> List[HistoryRow]:
+	"""
+	Return the positions of applications in all charts of a genre, store, and
+	type within the given time range, ordered by application and timestamp.
+	Entries of the first chart in the time range are not considered as
+	entered, and entries of the last chart are not considered as exited. The
+	packed applications of the charts are read with a single query and the
+	movements are computed from them, which does not require chart entries.
+	Without `names`, the latest metadata is only queried for skipping
+	applications. Like charts, the history is reused until the data changes.
+	"""
+
+	def load() -> List[HistoryRow]:
+		charts = Chart.objects.filter(
+			genre=genre,
+			store=store,
+			chart_type=chart_type,
+		)
+		if since is not None:
+			charts = charts.filter(timestamp__gte=since)
+		if until is not None:
+			charts = charts.filter(timestamp__lte=until)
+		rows = list(charts.order_by('timestamp').values_list('timestamp', 'packed_app_ids'))
+
+		# Positions of each application by the index of the chart
+		positions: Dict[int, Dict[int, int]] = defaultdict(dict)
+		for index, (_, packed_app_ids) in enumerate(rows):
+			for position, app_id in enumerate(unpack_app_ids(packed_app_ids)):
+				positions[app_id][index] = position
+
+		apps: Dict[int, Tuple[Optional[str], Optional[str]]]
+		if names or skip_bundles or skip_unknown:
+			apps = latest_applications(positions, skip_bundles, skip_unknown)
+		else:
+			apps = dict.fromkeys(positions, (None, None))
+		history: List[HistoryRow] = []
+		for app_id in sorted(apps):
+			by_chart = positions[app_id]
+			for index, position in by_chart.items():
+				previous = by_chart.get(index - 1)
+				history.append(HistoryRow(
+					rows[index][0],
+					position,
+					app_id,
+					*apps[app_id],
+					None if previous is None else previous - position,
+					0 < index and previous is None,
+					index < len(rows) - 1 and index + 1 not in by_chart,
+				))
+		return history
+
+	return cached(result_key(
+		'history',
+		store.pk,
+		genre.pk,
+		int(chart_type),
+		skip_bundles,
+		skip_unknown,
+		since.isoformat() if since is not None else None,
+		until.isoformat() if until is not None else None,
+		names,
+	), load)
@@ -0,0 +1,290 @@
+"""
+Generation of synthetic caches of the Mac App Store (MAS) for tests and
+benchmarks, since real caches only exist on macOS.
+
+A generated cache consists of a `Cache.db` with the same tables as the one of
+the MAS and an `fsCachedData` directory. It contains responses for all kinds
+of API requests handled by `mas_cache.cache.parse_resource`, i. e., lookups
+of applications, search results, charts, editorial rooms, and categories, as
+well as unrelated requests, e. g., for images. Like the MAS does, small
+responses are stored in the database and larger ones in files.
+
+Like `mas_cache.cache`, this module does not require Django.
+"""
+
+import json
+import os
+import random
+import sqlite3
+import uuid
+import zlib
+
+from datetime import datetime, timezone
+from typing import Any, Dict, NamedTuple, Optional
+
+
+API = 'https://api.apps.apple.com/v1'
+
+# Responses larger than this are stored in fsCachedData.
+INLINE_LIMIT = 4096
+
+# Applications per lookup, search result, and room
+PAGE_SIZE = 20
+
+CHART_TYPES = ['top-free', 'top-paid']
+
+GENRE_NAMES = [
+	'Business',
+	'Developer Tools',
+	'Education',
+	'Entertainment',
+	'Finance',
+	'Games',
+	'Graphics & Design',
+	'Health & Fitness',
+	'Lifestyle',
+	'Medical',
+	'Music',
+	'News',
+	'Photography',
+	'Productivity',
+	'Reference',
+	'Social Networking',
+	'Sports',
+	'Travel',
+	'Utilities',
+	'Video',
+	'Weather',
+]
+
+WORDS = (
+	'app mac pro lite photo video note task editor manager studio converter '
+	'simple smart fast easy cloud sync file text code data music player '
+	'calendar timer markdown scanner backup clean menu bar window screen'
+).split()
+
+SCHEMA = '''
+	CREATE TABLE cfurl_cache_response(
+		entry_ID INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+		version INTEGER,
+		hash_value INTEGER,
+		storage_policy INTEGER,
+		request_key TEXT UNIQUE,
+		time_stamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+		partition TEXT
+	);
+	CREATE TABLE cfurl_cache_blob_data(
+		entry_ID INTEGER PRIMARY KEY,
+		response_object BLOB,
+		request_object BLOB,
+		proto_props BLOB,
+		user_info BLOB
+	);
+	CREATE TABLE cfurl_cache_receiver_data(
+		entry_ID INTEGER PRIMARY KEY,
+		isDataOnFS INTEGER,
+		receiver_data BLOB
+	);
+	CREATE INDEX request_key_index ON cfurl_cache_response(request_key);
+	CREATE INDEX time_stamp_index ON cfurl_cache_response(time_stamp);
+	CREATE INDEX proto_props_index ON cfurl_cache_blob_data(entry_ID);
+	CREATE INDEX receiver_data_index ON cfurl_cache_receiver_data(entry_ID);
+'''
+
+
+class Sizes(NamedTuple):
+	apps: int = 1000
+	genres: int = 4  # Sub-genres of the App Store with charts
+	chart_size: int = 200
+	searches: int = 10
+	rooms: int = 5
+	images: int = 20  # Unrelated requests
+
+
+class CacheWriter:
+
+	def __init__(self, path: str, timestamp: datetime):
+		self.path = path
+		self.timestamp = timestamp.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+		os.makedirs(os.path.join(path, 'fsCachedData'), exist_ok=True)
+		self.db = sqlite3.connect(os.path.join(path, 'Cache.db'))
+		self.db.executescript(SCHEMA)
+
+	def add(self, url: str, data: bytes):
+		cursor = self.db.execute(
+			'INSERT INTO cfurl_cache_response(version, hash_value, storage_policy, request_key, time_stamp, partition) VALUES (0, ?, 0, ?, ?, NULL)',
+			(zlib.crc32(url.encode()), url, self.timestamp),
+		)
+		entry_id = cursor.lastrowid
+		self.db.execute(
+			'INSERT INTO cfurl_cache_blob_data(entry_ID, response_object, request_object, proto_props, user_info) VALUES (?, ?, ?, NULL, NULL)',
+			(entry_id, b'', b''),
+		)
+
+		receiver_data: Any = data
+		on_fs = INLINE_LIMIT < len(data)
+		if on_fs:
+			receiver_data = str(uuid.UUID(int=random.getrandbits(128))).upper()
+			with open(os.path.join(self.path, 'fsCachedData', receiver_data), 'wb') as fp:
+				fp.write(data)
+		self.db.execute(
+			'INSERT INTO cfurl_cache_receiver_data(entry_ID, isDataOnFS, receiver_data) VALUES (?, ?, ?)',
+			(entry_id, int(on_fs), receiver_data),
+		)
+
+	def add_json(self, url: str, data: Any):
+		self.add(url, json.dumps(data, ensure_ascii=False).encode())
+
+	def close(self):
+		self.db.commit()
+		self.db.close()
+
+
+def sentence(words: int) -> str:
+	return ' '.join(random.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def application(app_id: int, country: str, known: bool, bundle: bool) -> Dict[str, Any]:
+	app_type = 'app-bundles' if bundle else 'apps'
+	data: Dict[str, Any] = {
+		'id': str(app_id),
+		'type': app_type,
+		'href': f'/v1/catalog/{country}/{app_type}/{app_id}',
+	}
+	if not known:
+		# Placeholder of an application, which the MAS fetches lazily
+		return data
+
+	name = ' '.join(random.choice(WORDS) for _ in range(random.randint(1, 3))).title()
+	data['attributes'] = {
+		'name': name,
+		'artistName': sentence(2)[:-1],
+		'genreDisplayName': random.choice(GENRE_NAMES),
+		'userRating': {
+			'value': round(random.uniform(1, 5), 1),
+			'ratingCount': random.randint(0, 100000),
+		},
+		'platformAttributes': {
+			'osx': {
+				'bundleId': f'com.example.{name.lower().replace(" ", "-")}.{app_id}',
+				'description': {
+					'standard': ' '.join(sentence(12) for _ in range(random.randint(5, 30))),
+				},
+				'minimumOSVersion': f'10.{random.randint(9, 15)}',
+				'offers': [{
+					'type': 'get' if random.random() < 0.7 else 'buy',
+					'price': random.choice([0, 0.99, 4.99, 9.99]),
+					'currencyCode': 'USD',
+				}],
+				'versionHistory': [
+					{
+						'versionDisplay': f'{major}.{random.randint(0, 9)}',
+						'releaseNotes': sentence(10),
+					}
+					for major in range(random.randint(1, 5), 0, -1)
+				],
+			},
+		},
+	}
+	return data
+
+
+def generate(
+	path: str,
+	sizes: Sizes = Sizes(),
+	country: str = 'us',
+	seed: int = 0,
+	timestamp: Optional[datetime] = None,
+):
+	"""
+	Create a cache with `Cache.db` and `fsCachedData` in the directory `path`,
+	which must not contain a cache yet. The same seed yields the same cache.
+	"""
+
+	random.seed(seed)
+	if timestamp is None:
+		timestamp = datetime.now(timezone.utc)
+
+	# Some applications are only placeholders or bundles.
+	apps = [
+		application(
+			100000000 + i,
+			country,
+			known=random.random() < 0.9,
+			bundle=random.random() < 0.02,
+		)
+		for i in range(sizes.apps)
+	]
+	genres = [
+		(6000 + i, GENRE_NAMES[i % len(GENRE_NAMES)])
+		for i in range(sizes.genres)
+	]
+
+	writer = CacheWriter(path, timestamp)
+	try:
+		writer.add_json(f'{API}/editorial/{country}/categories', {
+			'results': {
+				'categories': [{
+					'genre': '36',
+					'name': 'App Store',
+					'children': [
+						{'genre': str(genre), 'name': name}
+						for genre, name in genres
+					],
+				}],
+			},
+		})
+
+		for start in range(0, len(apps), PAGE_SIZE):
+			page = apps[start:start + PAGE_SIZE]
+			ids = ','.join(app['id'] for app in page)
+			writer.add_json(f'{API}/catalog/{country}/apps?ids={ids}', {'data': page})
+
+		for i in range(sizes.searches):
+			writer.add_json(f'{API}/catalog/{country}/search?term=term{i}', {
+				'results': {
+					'search': {
+						'data': random.sample(apps, min(PAGE_SIZE, len(apps))),
+					},
+				},
+			})
+
+		for genre in [36] + [genre for genre, _ in genres]:
+			# Applications are either free or paid, so charts do not overlap.
+			chart_size = min(sizes.chart_size, len(apps) // len(CHART_TYPES))
+			chart_apps = random.sample(apps, chart_size * len(CHART_TYPES))
+			writer.add_json(f'{API}/catalog/{country}/charts?genre={genre}&types=apps', {
+				'results': {
+					'apps': [
+						{
+							'chart': chart_type,
+							'data': chart_apps[i * chart_size:(i + 1) * chart_size],
+						}
+						for i, chart_type in enumerate(CHART_TYPES)
+					],
+				},
+			})
+
+		for i in range(sizes.rooms):
+			writer.add_json(f'{API}/editorial/{country}/rooms/{i}', {
+				'data': [
+					{'type': 'groupings', 'relationships': {}},
+					{
+						'type': 'rooms',
+						'relationships': {
+							'contents': {
+								'data': random.sample(apps, min(PAGE_SIZE, len(apps))),
+							},
+						},
+					},
+				],
+			})
+
+		for i in range(sizes.images):
+			size = random.randint(1000, 10000)
+			writer.add(
+				f'https://is1-ssl.mzstatic.com/image/thumb/{i}/icon.png',
+				random.getrandbits(8 * size).to_bytes(size, 'little'),
+			)
+	finally:
+		writer.close()
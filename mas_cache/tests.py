@@ -1,3 +1,556 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import uuid
 
-# Create your tests here.
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, Tuple
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command, load_command_class
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from mas_cache import results
+from mas_cache.decoder import WILDCARD, Document
+from mas_cache.models import (
+	Application,
+	AppStore,
+	Chart,
+	ChartEntry,
+	ChartType,
+	DataVersion,
+	Genre,
+	LatestMetadata,
+	Metadata,
+	ScannedResponse,
+	pack_app_ids,
+)
+from mas_cache.partitions import partitioned_tables
+from mas_cache.synthetic import Sizes, generate
+
+
+SIZES = Sizes(apps=400, genres=2, chart_size=50, searches=3, rooms=2, images=2)
+
+
+# Strings contain escapes, surrogate pairs, and structural characters, which
+# must not be mistaken for the structure of the document.
+DOCUMENT = rb"""
+	{
+		"id" : "\"}]",
+		"caf\u00e9": "\ud83d\ude00 \\ \/ \b\f\n\r\t",
+		"nested":{"a":[[1, 2], {"b": {}}, []], "c": {"d": [ ]}},
+		"items": [
+			{"id": 1, "skip": {"id": [ "]", "{" ]}},
+			{"skip": "\"id\": 0", "id": -1.5e3},
+			{"id": true}, {"id": false}, {"id": null}, {"id": 0}
+		],
+		"empty": {}
+	}
+"""
+
+
+class DecoderTests(SimpleTestCase):
+
+	def test_values(self):
+		expected = json.loads(DOCUMENT)
+		document = Document(DOCUMENT)
+		for key in expected:
+			with self.subTest(key=key):
+				self.assertEqual(document.value((key,)), expected[key])
+		self.assertEqual(document.value(('nested', 'a')), expected['nested']['a'])
+		self.assertEqual(document.value(('nested', 'c', 'd')), [])
+		self.assertEqual(
+			list(document.values(('items', WILDCARD, 'id'))),
+			[item['id'] for item in expected['items']],
+		)
+		self.assertEqual(
+			list(document.values(('nested', 'a', WILDCARD))),
+			expected['nested']['a'],
+		)
+
+	def test_from_file(self):
+		with tempfile.NamedTemporaryFile() as fp:
+			fp.write(DOCUMENT)
+			fp.flush()
+			with Document.from_file(fp.name) as document:
+				self.assertEqual(document.value(('caf\u00e9',)), json.loads(DOCUMENT)['caf\u00e9'])
+
+	def test_missing_key(self):
+		document = Document(DOCUMENT)
+		for path in [('missing',), ('nested', 'missing'), ('empty', 'id')]:
+			with self.subTest(path=path), self.assertRaises(KeyError):
+				document.value(path)
+		# Items without the key fail, like indexing the decoded items.
+		with self.assertRaises(KeyError):
+			list(Document(b'[{"id": 1}, {}]').values((WILDCARD, 'id')))
+
+	def test_malformed(self):
+		# Only the values along the path are checked, since the rest of the
+		# document is never read.
+		for buffer, path in [
+			(b'', ('id',)),
+			(b' \n', ('id',)),
+			(b'{"id": "unterminated', ('id',)),
+			(b'{"id": "\\"}', ('id',)),
+			(b'{"id": [1, [2]', ('id',)),
+			(b'{"id": {"a": 1', ('id',)),
+			(b'{"a": 1', ('id',)),
+			(b'{"a": 1 "id": 2}', ('id',)),
+			(b'{"id" 1}', ('id',)),
+			(b'{"id": }', ('id',)),
+			(b'{"items": [1 2]}', ('items', WILDCARD)),
+		]:
+			with self.subTest(buffer=buffer):
+				with self.assertRaises(json.JSONDecodeError):
+					json.loads(buffer)
+				with self.assertRaises(json.JSONDecodeError):
+					list(Document(buffer).values(path))
+
+	def test_unexpected_type(self):
+		# Paths that expect a different type of value fail like malformed input.
+		for buffer, path in [
+			(b'[]', ('id',)),
+			(b'{"id": 1}', (WILDCARD,)),
+			(b'{"id": 1}', ('id', 'a')),
+		]:
+			with self.subTest(buffer=buffer), self.assertRaises(json.JSONDecodeError):
+				list(Document(buffer).values(path))
+
+
+class QueryBudgetTestCase(TestCase):
+	"""
+	Test case with a synthetic cache, which is scanned once for all tests. The
+	number of queries is limited by budgets, which catch N+1 queries. Budgets of
+	cached results include the query of the data version.
+	"""
+
+	@classmethod
+	def setUpClass(cls):
+		cls.cache_dir = tempfile.mkdtemp(prefix='mas-cache-')
+		generate(cls.cache_dir, SIZES, country='us')
+		super().setUpClass()
+
+	@classmethod
+	def tearDownClass(cls):
+		shutil.rmtree(cls.cache_dir)
+		super().tearDownClass()
+
+	def setUp(self):
+		# Results of other tests are cached, but the database is rolled back.
+		results.invalidate()
+
+	@contextmanager
+	def assertQueryBudget(self, budget: int) -> Iterator[CaptureQueriesContext]:
+		with CaptureQueriesContext(connection) as context:
+			yield context
+		self.assertLessEqual(
+			len(context),
+			budget,
+			"Query budget exceeded:\n" + "\n".join(
+				query['sql'] for query in context.captured_queries
+			),
+		)
+
+	def call(self, *args: str) -> str:
+		out = io.StringIO()
+		call_command(*args, stdout=out, stderr=io.StringIO())
+		return out.getvalue()
+
+	def scan(self, cache_dir: str):
+		self.call('scan', '--full', cache_dir)
+
+
+class ScanTests(QueryBudgetTestCase):
+
+	def test_scan(self):
+		with CaptureQueriesContext(connection) as context:
+			self.scan(self.cache_dir)
+		entries = ScannedResponse.objects.count()
+		self.assertEqual(Application.objects.count(), SIZES.apps)
+		self.assertLess(0, Metadata.objects.count())
+		self.assertLess(0, ChartEntry.objects.count())
+		self.assertLessEqual(len(context), 25 * entries)
+
+	def test_scan_queries_per_application(self):
+		# Applications are written in batches, so that the number of queries
+		# hardly depends on the number of applications per entry.
+		larger_dir = os.path.join(self.cache_dir, 'larger')
+		generate(larger_dir, SIZES._replace(chart_size=SIZES.chart_size * 2), country='de')
+
+		with CaptureQueriesContext(connection) as small:
+			self.scan(self.cache_dir)
+		with CaptureQueriesContext(connection) as large:
+			self.scan(larger_dir)
+
+		self.assertLessEqual(len(large), len(small) * 1.1)
+
+	def test_stats(self):
+		err = io.StringIO()
+		call_command('scan', '--full', '--stats', self.cache_dir, stdout=io.StringIO(), stderr=err)
+		stats = json.loads(err.getvalue().splitlines()[-1])
+		self.assertEqual(stats['counters']['responses'], ScannedResponse.objects.count())
+		self.assertEqual(stats['counters']['applications'], Metadata.objects.count())
+		self.assertLessEqual(
+			sum(phase['queries'] for phase in stats['phases'].values()),
+			stats['queries'],
+		)
+
+	def test_empty_database(self):
+		for args in [['charts'], ['metadata', '1']]:
+			with self.subTest(args=args), self.assertRaisesMessage(CommandError, "No stores found."):
+				self.call(*args)
+
+	def test_invalid_snapshot(self):
+		# Snapshots are opened read-only, so a missing Cache.db is not created.
+		missing = os.path.join(self.cache_dir, 'missing', 'Cache.db')
+		os.makedirs(os.path.dirname(missing))
+		with self.assertRaisesMessage(CommandError, "No such file or directory"):
+			self.scan(missing)
+		self.assertFalse(os.path.exists(missing))
+
+		with open(missing, 'w'):
+			pass
+		with self.assertRaisesMessage(CommandError, "Failed to read snapshot"):
+			self.scan(missing)
+		self.assertEqual(os.path.getsize(missing), 0)
+
+	def test_snapshots(self):
+		archive_dir = tempfile.mkdtemp(prefix='mas-cache-')
+		self.addCleanup(shutil.rmtree, archive_dir)
+		snapshots = {
+			'directory': self.cache_dir,
+			'Cache.db': os.path.join(self.cache_dir, 'Cache.db'),
+			'tar': shutil.make_archive(os.path.join(archive_dir, 'snapshot'), 'gztar', self.cache_dir),
+			'zip': shutil.make_archive(os.path.join(archive_dir, 'snapshot'), 'zip', self.cache_dir),
+		}
+
+		def ingested(snapshot: str) -> Tuple[int, int, str]:
+			with transaction.atomic():
+				self.call('scan', snapshot)
+				result = (
+					ScannedResponse.objects.count(),
+					Metadata.objects.count(),
+					self.call('charts', '--json'),
+				)
+				transaction.set_rollback(True)
+			return result
+
+		expected = ingested(snapshots['directory'])
+		self.assertLess(0, expected[0])
+		self.assertLess(0, expected[1])
+		for kind, snapshot in snapshots.items():
+			with self.subTest(kind=kind):
+				self.assertEqual(ingested(snapshot), expected)
+
+	def test_rescan(self):
+		self.scan(self.cache_dir)
+		with self.assertQueryBudget(5):
+			self.call('scan', self.cache_dir)
+
+
+class ParallelScanTests(TransactionTestCase):
+	"""
+	Scanning with worker processes closes the database connection, which
+	would abort the transaction of a `TestCase`.
+	"""
+
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp(prefix='mas-cache-')
+		generate(self.cache_dir, SIZES, country='us')
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+
+	def scan(self, jobs: int) -> Tuple[str, str]:
+		call_command('flush', interactive=False, verbosity=0)
+		results.invalidate()
+		call_command('scan', '--full', '--jobs', str(jobs), self.cache_dir, stdout=io.StringIO())
+		outputs = []
+		for args in [['metadata', '--dump'], ['charts', '--json']]:
+			out = io.StringIO()
+			call_command(*args, stdout=out)
+			outputs.append(out.getvalue())
+		return outputs[0], outputs[1]
+
+	def test_jobs(self):
+		serial = self.scan(jobs=1)
+		self.assertEqual(len(serial[0].splitlines()), Metadata.objects.count())
+		self.assertEqual(self.scan(jobs=3), serial)
+
+
+class ReadTests(QueryBudgetTestCase):
+
+	@classmethod
+	def setUpTestData(cls):
+		call_command('scan', '--full', cls.cache_dir, stdout=io.StringIO())
+		cls.app_id = Application.objects.filter(
+			latest_by_store__is_known=True,
+			latest_by_store__app_type='apps',
+		).order_by('itunes_id').values_list('itunes_id', flat=True).first()
+
+	def test_arguments(self):
+		# Defaults are resolved lazily, so parsing, e. g., for --help, does not
+		# query the database.
+		for command in ['charts', 'metadata', 'scan']:
+			parser = load_command_class('mas_cache', command).create_parser('manage', command)
+			with self.subTest(command=command), self.assertQueryBudget(0):
+				parser.parse_args([])
+
+	def test_invalid_options(self):
+		with self.assertRaisesMessage(CommandError, "The chunk size needs to be positive."):
+			self.call('export', self.cache_dir, '--chunk-size', '0')
+		for interval in ['0', '-1']:
+			with self.subTest(interval=interval), self.assertRaisesMessage(CommandError, "The interval needs to be positive."):
+				self.call('scan', '--watch', '--interval', interval, self.cache_dir)
+
+	def test_charts(self):
+		with self.assertQueryBudget(5):
+			output = self.call('charts', '--skip-bundles', '--skip-unknown')
+		self.assertIn("Pos", output)
+
+	def test_charts_cached(self):
+		self.call('charts', '--json')
+		with self.assertQueryBudget(1):
+			self.call('charts', '--json')
+
+	def test_charts_other_process(self):
+		# Another process commits a newer chart along with a new data version,
+		# which this process sees once it reads the version again.
+		with mock.patch.object(results, 'VERSION_TTL', 0):
+			self.call('charts', '--json')
+			chart = Chart.objects.filter(genre=36, chart_type=ChartType.FREE).get()
+			Chart.objects.filter(pk=chart.pk).update(timestamp=chart.timestamp + timedelta(hours=1))
+			DataVersion.objects.update(token=uuid.uuid4().hex)
+			output = json.loads(self.call('charts', '--json'))
+		self.assertEqual(output['timestamp'], str(chart.timestamp + timedelta(hours=1)))
+
+	def test_charts_history(self):
+		with self.assertQueryBudget(4):
+			self.call('charts', '--history', '--json')
+
+	def test_metadata(self):
+		with self.assertQueryBudget(4):
+			self.call('metadata', str(self.app_id))
+
+	def test_name_prefix(self):
+		name = Application.objects.with_latest().filter(
+			pk=self.app_id,
+		).values_list('latest_name', flat=True).get()
+		self.assertIn(self.app_id, Application.objects.with_name(name[:3], prefix=True).values_list('pk', flat=True))
+		self.assertNotIn(self.app_id, Application.objects.with_name(name[:3].lower(), prefix=True).values_list('pk', flat=True))
+		self.assertNotIn(self.app_id, Application.objects.with_name(name + '\U0010ffff', prefix=True).values_list('pk', flat=True))
+
+	def test_metadata_dump(self):
+		with self.assertQueryBudget(2):
+			output = self.call('metadata', '--dump')
+		self.assertEqual(len(output.splitlines()), Metadata.objects.count())
+
+	def test_api_chart(self):
+		with self.assertQueryBudget(5):
+			response = self.client.get('/api/charts/us/36/free/?per_page=1000')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(response.json()['entries']), SIZES.chart_size)
+
+		with self.assertQueryBudget(3):
+			response = self.client.get(
+				'/api/charts/us/36/free/?per_page=1000',
+				HTTP_IF_NONE_MATCH=response['ETag'],
+			)
+		self.assertEqual(response.status_code, 304)
+
+	def test_api_chart_history(self):
+		with self.assertQueryBudget(4):
+			response = self.client.get('/api/charts/us/36/free/history/')
+		self.assertEqual(response.status_code, 200)
+
+		# The history is neither loaded nor computed for a matching ETag.
+		with self.assertQueryBudget(3) as context:
+			response = self.client.get(
+				'/api/charts/us/36/free/history/',
+				HTTP_IF_NONE_MATCH=response['ETag'],
+			)
+		self.assertEqual(response.status_code, 304)
+		self.assertFalse(any('mas_cache_chart' in query['sql'] for query in context.captured_queries))
+
+	def test_api_metadata(self):
+		with self.assertQueryBudget(4):
+			response = self.client.get(f'/api/apps/{self.app_id}/')
+		self.assertEqual(response.status_code, 200)
+
+		# A newer snapshot with the same content changes the response.
+		metadata = Metadata.objects.select_related('blob').get(
+			application=self.app_id,
+			blob=response.json()['digest'],
+		)
+		newer = Metadata.objects.create(
+			application_id=self.app_id,
+			store_id=metadata.store_id,
+			source=metadata.source + '?newer',
+			timestamp=metadata.timestamp + timedelta(hours=1),
+			blob=metadata.blob,
+		)
+		LatestMetadata.objects.track([newer])
+		results.invalidate()
+		response = self.client.get(f'/api/apps/{self.app_id}/', HTTP_IF_NONE_MATCH=response['ETag'])
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.json()['timestamp'], str(newer.timestamp))
+
+	def test_admin_change_lists(self):
+		user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+		self.client.force_login(user)
+		for model in ['application', 'chartentry', 'metadata']:
+			with self.subTest(model=model), self.assertQueryBudget(8):
+				response = self.client.get(f'/admin/mas_cache/{model}/')
+			self.assertEqual(response.status_code, 200)
+
+	def test_admin_chart(self):
+		# Entries are read-only and their applications are not queried per row.
+		user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+		self.client.force_login(user)
+		chart = Chart.objects.order_by('pk').first()
+		with self.assertQueryBudget(10):
+			response = self.client.get(f'/admin/mas_cache/chart/{chart.pk}/change/')
+		self.assertEqual(response.status_code, 200)
+		self.assertNotContains(response, 'name="entries-0-application"')
+		self.assertContains(response, 'name="entries-MAX_NUM_FORMS" value="0"')
+
+
+class ChartStorageTests(QueryBudgetTestCase):
+
+	def scan_snapshots(self, country: str):
+		start = datetime(2020, 4, 1, tzinfo=timezone.utc)
+		for i, seed in enumerate([0, 1, 1, 0]):
+			cache_dir = tempfile.mkdtemp(dir=self.cache_dir)
+			generate(cache_dir, SIZES, country=country, seed=seed, timestamp=start + timedelta(hours=i))
+			self.scan(cache_dir)
+
+	def test_history(self):
+		store = AppStore.objects.create(country='us')
+		genre = Genre.objects.create(itunes_id=36)
+		start = datetime(2020, 4, 1, tzinfo=timezone.utc)
+		timestamps = [start + timedelta(hours=i) for i in range(3)]
+		for timestamp, app_ids in zip(timestamps, [[1, 2, 3], [2, 1, 4], [1, 4]]):
+			Chart.objects.create(
+				store=store,
+				genre=genre,
+				chart_type=ChartType.FREE,
+				timestamp=timestamp,
+				packed_app_ids=pack_app_ids(app_ids),
+			)
+
+		def history(since: datetime):
+			return [
+				(timestamps.index(row.timestamp), row.position, row.app_id, row.movement, row.entered, row.exited)
+				for row in results.chart_history(store, genre, ChartType.FREE, since=since, names=False)
+			]
+
+		self.assertEqual(history(timestamps[0]), [
+			(0, 0, 1, None, False, False),
+			(1, 1, 1, -1, False, False),
+			(2, 0, 1, 1, False, False),
+			(0, 1, 2, None, False, False),
+			(1, 0, 2, 1, False, True),
+			(0, 2, 3, None, False, True),
+			(1, 2, 4, None, True, False),
+			(2, 1, 4, 1, False, False),
+		])
+		# Entries of the first chart in the time range are not considered as
+		# entered or moved.
+		self.assertEqual(history(timestamps[1])[:3], [
+			(1, 1, 1, None, False, False),
+			(2, 0, 1, 1, False, False),
+			(1, 0, 2, None, False, True),
+		])
+
+	def test_without_entries(self):
+		# Charts are read without the entries, which can be disabled.
+		self.scan_snapshots('us')
+		commands = [['charts', '--json'], ['charts', '--history']]
+		outputs = [self.call(*args) for args in commands]
+		ChartEntry.objects.all().delete()
+		results.invalidate()
+		self.assertEqual([self.call(*args) for args in commands], outputs)
+
+		with override_settings(CHART_ENTRIES=False):
+			self.scan_snapshots('de')
+		self.assertFalse(ChartEntry.objects.exists())
+		self.assertEqual(Chart.objects.filter(store='de').count(), Chart.objects.filter(store='us').count())
+
+
+class CompactChartsTests(QueryBudgetTestCase):
+
+	def test_compact_charts(self):
+		hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+		snapshots = [
+			# Thinned out to one chart per hour
+			(hour - timedelta(days=30, minutes=55), 2),
+			(hour - timedelta(days=30, minutes=25), 3),
+			(hour - timedelta(days=30) + timedelta(minutes=5), 4),
+			# Identical charts are collapsed, but the latest chart is kept.
+			(hour - timedelta(days=1), 0),
+			(hour - timedelta(days=1) + timedelta(minutes=1), 0),
+			(hour - timedelta(days=1) + timedelta(minutes=2), 1),
+			(hour - timedelta(days=1) + timedelta(minutes=3), 1),
+		]
+		for i, (timestamp, seed) in enumerate(snapshots):
+			cache_dir = os.path.join(self.cache_dir, f'compact-{i}')
+			generate(cache_dir, SIZES, country='us', seed=seed, timestamp=timestamp)
+			self.scan(cache_dir)
+		series = Chart.objects.values('store', 'genre', 'chart_type').distinct().count()
+		charts = Chart.objects.count()
+		self.assertEqual(charts, series * len(snapshots))
+
+		self.call('compact_charts', '--dry-run')
+		self.assertEqual(Chart.objects.count(), charts)
+
+		self.call('compact_charts', '--policy', '7d=all,90d=1h,1d', '--batch-size', '3')
+		self.assertEqual(Chart.objects.count(), series * 5)
+		self.assertFalse(ChartEntry.objects.exclude(chart__in=Chart.objects.all()).exists())
+		self.assertEqual(
+			set(Chart.objects.values_list('timestamp', flat=True)),
+			{snapshots[i][0] for i in [0, 2, 3, 5, 6]},
+		)
+
+		# Compacting is idempotent.
+		self.call('compact_charts', '--batch-size', '3')
+		self.assertEqual(Chart.objects.count(), series * 5)
+
+
+@skipUnless(connection.vendor == 'postgresql', "Partitioning requires PostgreSQL.")
+class PartitionTests(QueryBudgetTestCase):
+
+	def test_partitions(self):
+		self.scan(self.cache_dir)
+		charts = self.call('charts', '--json')
+		history = self.call('charts', '--history', '--json')
+
+		self.call('partitions', '--enable')
+		self.assertEqual(set(partitioned_tables()), {'mas_cache_metadata', 'mas_cache_chartentry'})
+		results.invalidate()
+		self.assertEqual(self.call('charts', '--json'), charts)
+		self.assertEqual(self.call('charts', '--history', '--json'), history)
+		with self.assertQueryBudget(3):
+			self.call('metadata', str(Application.objects.filter(
+				latest_by_store__is_known=True,
+			).values_list('itunes_id', flat=True).first()))
+
+		# Partitions of older snapshots are created when scanning.
+		old_dir = os.path.join(self.cache_dir, 'old')
+		generate(old_dir, SIZES, country='de', timestamp=datetime(2020, 1, 15, tzinfo=timezone.utc))
+		self.scan(old_dir)
+		self.assertIn((2020, 1), partitioned_tables()['mas_cache_metadata'])
+		entries = ChartEntry.objects.filter(chart__store='us').count()
+
+		# The metadata is still the latest of the store, so it is kept.
+		self.call('partitions', '--detach', '2020-03-01')
+		self.assertIn((2020, 1), partitioned_tables()['mas_cache_metadata'])
+		self.assertNotIn((2020, 1), partitioned_tables()['mas_cache_chartentry'])
+		self.assertEqual(ChartEntry.objects.count(), entries)
+		# Charts are kept and still read from their packed applications.
+		self.assertIn('"app_id"', self.call('charts', '--store', 'de', '--json'))
@@ -0,0 +1,22 @@
+from django.urls import path
+
+from mas_cache import views
+
+
+app_name = 'mas_cache'
+
+urlpatterns = [
+	path('stores/', views.stores, name='stores'),
+	path('genres/', views.genres, name='genres'),
+	path(
+		'charts/<str:country>/<int:genre_id>/<str:chart_type>/',
+		views.chart,
+		name='chart',
+	),
+	path(
+		'charts/<str:country>/<int:genre_id>/<str:chart_type>/history/',
+		views.chart_history,
+		name='chart-history',
+	),
+	path('apps/<int:app_id>/', views.metadata, name='metadata'),
+]
@@ -1,3 +1,314 @@
-from django.shortcuts import render
+"""
+Read-only JSON API for charts and metadata.
 
-# Create your views here.
+Views are asynchronous, so that a single process can serve many concurrent
+requests, and run their queries in a thread. Responses carry an `ETag`, which
+is derived from the chart timestamp, the metadata digest, or the data version
+of `mas_cache.results`, and `If-None-Match` is answered with 304 Not Modified.
+"""
+
+import hashlib
+
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple, TypeVar
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import InvalidPage, Paginator
+from django.http import (
+	HttpRequest,
+	HttpResponse,
+	HttpResponseNotAllowed,
+	HttpResponseNotModified,
+	JsonResponse,
+)
+from django.utils.http import parse_etags, quote_etag
+from django.utils.timezone import datetime
+
+from mas_cache.management import TimestampType
+from mas_cache.models import Application, AppStore, ChartType, Genre
+from mas_cache.results import (
+	cached,
+	chart_history as load_chart_history,
+	data_version,
+	latest_chart,
+	result_key,
+)
+
+
+CHART_TYPES = {
+	'free': ChartType.FREE,
+	'paid': ChartType.PAID,
+}
+
+PER_PAGE = 100
+MAX_PER_PAGE = 1000
+
+T = TypeVar('T')
+
+View = Callable[..., Awaitable[HttpResponse]]
+
+
+class ApiError(Exception):
+
+	def __init__(self, message: str, status: int = 400):
+		super().__init__(message)
+		self.status = status
+
+
+def api_view(view: View) -> View:
+	"""
+	Only allow safe methods and turn `ApiError` into JSON responses.
+	"""
+
+	@wraps(view)
+	async def wrapper(request: HttpRequest, *args, **kwargs) -> HttpResponse:
+		if request.method not in ('GET', 'HEAD'):
+			return HttpResponseNotAllowed(['GET', 'HEAD'])
+		try:
+			return await view(request, *args, **kwargs)
+		except ApiError as e:
+			return JsonResponse({'error': str(e)}, status=e.status)
+
+	return wrapper
+
+
+async def respond(
+	request: HttpRequest,
+	etag: str,
+	build: Callable[[], Any],
+) -> HttpResponse:
+	"""
+	Respond with the result of `build`, unless the client already has the
+	representation identified by `etag`.
+	"""
+
+	etag = quote_etag(hashlib.sha1(etag.encode()).hexdigest())
+	if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+	if etag in if_none_match or '*' in if_none_match:
+		response: HttpResponse = HttpResponseNotModified()
+	else:
+		response = JsonResponse(await sync_to_async(build)(), safe=False)
+	response['ETag'] = etag
+	return response
+
+
+# Parameters
+
+
+def flag(request: HttpRequest, name: str) -> bool:
+	return request.GET.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def timestamp(request: HttpRequest, name: str) -> Optional[datetime]:
+	value = request.GET.get(name)
+	if value is None:
+		return None
+	try:
+		return TimestampType(value)
+	except ValueError:
+		raise ApiError(f"Invalid timestamp for {name}: {value}")
+
+
+def number(request: HttpRequest, name: str, default: int) -> int:
+	value = request.GET.get(name)
+	if value is None:
+		return default
+	try:
+		return int(value)
+	except ValueError:
+		raise ApiError(f"Invalid number for {name}: {value}")
+
+
+def paginate(
+	request: HttpRequest,
+	entries: Sequence[T],
+	convert: Callable[[T], Any],
+) -> Dict[str, Any]:
+	"""
+	Return the page of `entries` requested by the `page` and `per_page`
+	parameters. Only the entries of the page are converted.
+	"""
+
+	per_page = min(max(number(request, 'per_page', PER_PAGE), 1), MAX_PER_PAGE)
+	paginator = Paginator(entries, per_page)
+	try:
+		page = paginator.page(number(request, 'page', 1))
+	except InvalidPage as e:
+		raise ApiError(str(e), 404)
+	return {
+		'count': paginator.count,
+		'page': page.number,
+		'pages': paginator.num_pages,
+		'entries': [convert(entry) for entry in page],
+	}
+
+
+def resolve_series(
+	country: str,
+	genre_id: int,
+	chart_type: str,
+) -> Tuple[AppStore, Genre, ChartType]:
+	try:
+		store = AppStore.objects.get(country=country)
+	except AppStore.DoesNotExist:
+		raise ApiError(f"Unknown store: {country}", 404)
+	try:
+		genre = Genre.objects.get(itunes_id=genre_id)
+	except Genre.DoesNotExist:
+		raise ApiError(f"Unknown genre: {genre_id}", 404)
+	if chart_type not in CHART_TYPES:
+		raise ApiError(f"Unknown chart type: {chart_type}", 404)
+	return store, genre, CHART_TYPES[chart_type]
+
+
+# Views
+
+
+@api_view
+async def stores(request: HttpRequest) -> HttpResponse:
+	def build() -> Any:
+		return list(AppStore.objects.order_by('country').values_list('country', flat=True))
+
+	return await respond(request, await sync_to_async(data_version)(), build)
+
+
+@api_view
+async def genres(request: HttpRequest) -> HttpResponse:
+	def build() -> Any:
+		return [
+			{'id': itunes_id, 'name': name, 'parent': parent}
+			for itunes_id, name, parent in Genre.objects.order_by('itunes_id').values_list(
+				'itunes_id',
+				'name',
+				'parent',
+			)
+		]
+
+	return await respond(request, await sync_to_async(data_version)(), build)
+
+
+@api_view
+async def chart(
+	request: HttpRequest,
+	country: str,
+	genre_id: int,
+	chart_type: str,
+) -> HttpResponse:
+	def load() -> Tuple[str, Callable[[], Any]]:
+		store, genre, chart_type_ = resolve_series(country, genre_id, chart_type)
+		chart = latest_chart(
+			store,
+			genre,
+			chart_type_,
+			flag(request, 'skip_bundles'),
+			flag(request, 'skip_unknown'),
+			timestamp(request, 'at'),
+		)
+		if chart is None:
+			raise ApiError("No charts found.", 404)
+
+		def build() -> Any:
+			return {
+				'type': chart_type_.to_api(),
+				'genre': genre.itunes_id,
+				'store': store.country,
+				'timestamp': str(chart.timestamp),
+				**paginate(request, chart.rows, lambda row: {
+					'position': row.position + 1,
+					'app_id': row.app_id,
+					'bundle_identifier': row.bundle_identifier,
+					'name': row.name,
+				}),
+			}
+
+		# Names and bundle identifiers change with the latest metadata.
+		return f'{chart.timestamp.isoformat()}:{data_version()}', build
+
+	etag, build = await sync_to_async(load)()
+	return await respond(request, etag, build)
+
+
+@api_view
+async def chart_history(
+	request: HttpRequest,
+	country: str,
+	genre_id: int,
+	chart_type: str,
+) -> HttpResponse:
+	def load() -> Tuple[str, Callable[[], Any]]:
+		store, genre, chart_type_ = resolve_series(country, genre_id, chart_type)
+		since = timestamp(request, 'since')
+		until = timestamp(request, 'until')
+		skip_bundles = flag(request, 'skip_bundles')
+		skip_unknown = flag(request, 'skip_unknown')
+
+		# The history is only loaded if the client does not have it yet.
+		def build() -> Any:
+			rows = load_chart_history(
+				store,
+				genre,
+				chart_type_,
+				skip_bundles,
+				skip_unknown,
+				since,
+				until,
+				names=False,
+			)
+			return {
+				'type': chart_type_.to_api(),
+				'genre': genre.itunes_id,
+				'store': store.country,
+				**paginate(request, rows, lambda row: {
+					'timestamp': str(row.timestamp),
+					'position': row.position + 1,
+					'app_id': row.app_id,
+					'movement': row.movement,
+					'entered': row.entered,
+					'exited': row.exited,
+				}),
+			}
+
+		return data_version(), build
+
+	etag, build = await sync_to_async(load)()
+	return await respond(request, etag, build)
+
+
+@api_view
+async def metadata(request: HttpRequest, app_id: int) -> HttpResponse:
+	def load() -> Dict[str, Any]:
+		country = request.GET.get('store')
+		store = (
+			AppStore.objects.filter(country=country)
+			if country is not None
+			else AppStore.objects.all()
+		).first()
+		if store is None:
+			raise ApiError(f"Unknown store: {country}", 404)
+
+		def find() -> Optional[Dict[str, Any]]:
+			app = Application.objects.filter(itunes_id=app_id).first()
+			if app is None:
+				return None
+			metadata = app.latest_known_metadata(store)
+			if metadata is None:
+				return None
+			return {
+				'app_id': app.itunes_id,
+				'store': store.country,
+				'source': metadata.source,
+				'timestamp': str(metadata.timestamp),
+				'digest': metadata.digest,
+				'data': metadata.data,
+			}
+
+		result = cached(result_key('api-metadata', store.pk, app_id), find)
+		if result is None:
+			raise ApiError(f"No metadata for app: {app_id}", 404)
+		return result
+
+	result = await sync_to_async(load)()
+	# The same content may be stored again by a newer snapshot, which changes
+	# the source and timestamp of the response.
+	etag = f"{result['digest']}:{result['store']}:{result['source']}:{result['timestamp']}"
+	return await respond(request, etag, lambda: result)
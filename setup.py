@@ -4,9 +4,14 @@ setup(
 	name='mas-cache',
 	version='0.0.1',
 	install_requires=[
-		'django',
+		'django>=3.1',
 		'psycopg2-binary',
 	],
+	extras_require=dict(
+		export=[
+			'pyarrow',
+		],
+	),
 	entry_points=dict(
 		console_scripts=[
 			'manage=manage:main',